@@ -8,5 +8,19 @@ export PYTHONPATH="${PYTHONPATH}:./birdnetsrc"
 # Files to process
 FILE_LIST="files_to_analyze.csv"
 
-# Using GNU Parallel to process each file
-parallel --progress --eta --resume --joblog status.txt python analyse.py :::: $FILE_LIST
+# Set REFRESH_CATALOG=1 to list the remote audio files from the catalog
+# (CATALOG_FILE in config_connection.yaml) instead of an existing file list
+if [ "${REFRESH_CATALOG:-0}" = "1" ]; then
+    python src/catalog.py --config config_connection.yaml > $FILE_LIST
+fi
+
+# Number of files handed to each worker. Every worker loads the model once
+# and keeps it in memory for all of its files.
+FILES_PER_WORKER=50
+
+# Using GNU Parallel to process the files in batches of FILES_PER_WORKER.
+# A batch exits non-zero if any of its files failed, and --resume-failed
+# runs such batches again (files already analysed are skipped with
+# SKIP_EXISTING_RESULTS). Keep FILE_LIST and FILES_PER_WORKER unchanged
+# between resumed runs, the joblog records batches and not files.
+parallel --progress --eta --resume-failed --joblog status.txt -n $FILES_PER_WORKER python analyse.py :::: $FILE_LIST
@@ -0,0 +1,75 @@
+"""Compares audio decoding time per audio-hour against the librosa path.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_decode.py --minutes 10
+"""
+
+import argparse
+import pathlib
+import tempfile
+import time
+
+import librosa
+import numpy as np
+import soundfile as sf
+from utils import FFMPEG, decode_audio
+
+TARGET_SR = 48000
+
+
+def make_recording(path, minutes, sr, subtype=None):
+    """Writes a synthetic mono recording (noise and chirps) to ``path``."""
+    rng = np.random.default_rng(42)
+    n = int(minutes * 60 * sr)
+    t = np.arange(n) / sr
+    sig = 0.05 * rng.standard_normal(n) + 0.2 * np.sin(
+        2 * np.pi * (2000 + 500 * t % 3000) * t
+    )
+    sf.write(path, sig.astype(np.float32), sr, subtype=subtype)
+
+
+def librosa_decode(path, sr):
+    """The previous decoding path, kept as the reference."""
+    return librosa.load(path, sr=sr, mono=True, res_type="kaiser_fast")
+
+
+def time_decode(fn, path, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        with pathlib.Path(path).open("rb") as f:
+            wave, sr = fn(f, TARGET_SR)
+        best = min(best, time.perf_counter() - t0)
+    return best, len(wave) / sr
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--minutes", type=float, default=5, help="Length of each recording."
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Best of N runs.")
+    args = parser.parse_args()
+
+    cases = [
+        ("wav", 48000, "PCM_16"),
+        ("wav", 44100, "PCM_16"),
+        ("flac", 48000, "PCM_16"),
+    ]
+    if FFMPEG or "MP3" in sf.available_formats():
+        cases.append(("mp3", 44100, None))
+
+    print(f"ffmpeg: {FFMPEG or 'not installed'}")
+    print(f"{'format':<12}{'librosa s/h':>14}{'decode_audio s/h':>18}{'speed-up':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for fmt, sr, subtype in cases:
+            path = str(pathlib.Path(tmp) / f"bench_{sr}.{fmt}")
+            make_recording(path, args.minutes, sr, subtype)
+
+            ref, seconds = time_decode(librosa_decode, path, args.repeat)
+            new, _ = time_decode(decode_audio, path, args.repeat)
+            per_hour = 3600 / seconds
+            print(
+                f"{fmt + '@' + str(sr // 1000) + 'k':<12}{ref * per_hour:>14.2f}"
+                f"{new * per_hour:>18.2f}{ref / new:>9.1f}x"
+            )
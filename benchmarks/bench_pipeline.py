@@ -0,0 +1,257 @@
+"""Times the analysis, parsing, sampling and extraction steps on synthetic data.
+
+Runs offline: recordings are generated in a temporary directory and served
+through a local ``fs`` filesystem, and ``predict`` is replaced by a
+deterministic stub so that no BirdNET checkpoint is needed. Each scale is
+given as FILESxMINUTES. Before timing, ``check_streaming`` checks that
+STREAM_AUDIO splits recordings into the same chunks as whole-file analysis.
+
+Usage:
+    PYTHONPATH=src:src/birdnetsrc python benchmarks/bench_pipeline.py --scales 4x5 4x60
+"""
+
+import argparse
+import contextlib
+import io
+import pathlib
+import tempfile
+import time
+import zlib
+
+import analysefs
+import config as cfg
+import fs.osfs
+import numpy as np
+import pyarrow as pa
+import soundfile as sf
+from detections import SEGMENT_SCHEMA, add_site_columns, write_detections
+from extract import extract_all
+from global_sampler import reservoir_sample, stratified_sample
+from labels import LabelRegistry
+from metrics import append_jsonl
+from parse_results import parse_files, parse_folders
+
+
+def make_recording(path, minutes, sr, seed, block_minutes=1):
+    """Writes a synthetic mono recording (noise and chirps) block by block."""
+    rng = np.random.default_rng(seed)
+    block = int(block_minutes * 60 * sr)
+    n = int(minutes * 60 * sr)
+    with sf.SoundFile(path, "w", sr, 1, subtype="PCM_16") as f:
+        for start in range(0, n, block):
+            t = np.arange(start, min(n, start + block)) / sr
+            sig = 0.05 * rng.standard_normal(len(t)) + 0.2 * np.sin(
+                2 * np.pi * (2000 + 500 * t % 3000) * t
+            )
+            f.write(sig.astype(np.float32))
+
+
+def make_dataset(root, n_files, minutes, fmt, sr):
+    """Writes ``n_files`` recordings as ``root/SITEnn/YYYYMMDD_HHMMSS.fmt``."""
+    paths = []
+    for i in range(n_files):
+        site = f"SITE{i % 4:02d}"
+        (pathlib.Path(root) / site).mkdir(parents=True, exist_ok=True)
+        name = f"202404{i % 28 + 1:02d}_{i % 24:02d}0000.{fmt}"
+        path = str(pathlib.Path(root) / site / name)
+        make_recording(path, minutes, sr, seed=i)
+        paths.append(path)
+    return paths
+
+
+def stub_predict(n_labels, seed=0):
+    """Deterministic stand-in for ``predict``: scores only depend on the chunk."""
+
+    def predict(samples):
+        scores = np.empty((len(samples), n_labels), dtype=np.float32)
+        for i, chunk in enumerate(samples):
+            data = np.ascontiguousarray(chunk, dtype=np.float32).tobytes()
+            rng = np.random.default_rng([seed, zlib.crc32(data)])
+            # Mostly low scores with a few confident detections per chunk
+            scores[i] = rng.random(n_labels) ** 8
+        return scores
+
+    return predict
+
+
+def configure(result_dir, n_labels):
+    cfg.LABELS = [f"Genus{i} species{i}_Common name {i}" for i in range(n_labels)]
+    cfg.TRANSLATED_LABELS = cfg.LABELS
+    cfg.CODES = {}
+    cfg.SPECIES_LIST = []
+    cfg.LABEL_REGISTRY = LabelRegistry(cfg.LABELS, cfg.TRANSLATED_LABELS, cfg.CODES)
+    cfg.OUTPUT_PATH = result_dir
+    cfg.ERROR_LOG_FILE = pathlib.Path(result_dir) / "errors.txt"
+    cfg.MANIFEST_FILE = None
+    cfg.METRICS_FILE = None
+    cfg.SKIP_EXISTING_RESULTS = False
+    analysefs.predict = stub_predict(n_labels)
+
+
+def best_of(fn, repeat, quiet):
+    """Runs ``fn`` ``repeat`` times and returns its last result and best time."""
+    best = float("inf")
+    for _ in range(repeat):
+        out = io.StringIO() if quiet else None
+        with contextlib.redirect_stdout(out) if quiet else contextlib.nullcontext():
+            t0 = time.perf_counter()
+            result = fn()
+            best = min(best, time.perf_counter() - t0)
+    return result, best
+
+
+def check_streaming(tmp, sr):
+    """Checks that streamed and whole-file analysis give the same chunks.
+
+    The recordings are not a whole number of windows long, so that the last
+    window is shorter than a chunk.
+    """
+    saved = cfg.STREAM_AUDIO, cfg.FILE_SPLITTING_DURATION, cfg.SIG_OVERLAP
+    cfg.FILE_SPLITTING_DURATION = 9
+    try:
+        for seconds in (63.4, 60.8):
+            path = str(pathlib.Path(tmp) / f"check_{seconds}.wav")
+            make_recording(path, seconds / 60, sr, seed=0)
+            for overlap in (0, 1):
+                cfg.SIG_OVERLAP = overlap
+                results = []
+                for stream in (False, True):
+                    cfg.STREAM_AUDIO = stream
+                    results.append(list(analysefs.iter_chunks(path)))
+                whole, streamed = results
+                np.testing.assert_equal(
+                    [t for _, t, _ in streamed],
+                    [t for _, t, _ in whole],
+                    err_msg=f"{seconds} s, overlap {overlap}: chunks differ",
+                )
+                # The last chunk is padded with random noise
+                end = int((seconds - whole[-1][1][0]) * cfg.SAMPLE_RATE)
+                for i, ((a, _, _), (b, _, _)) in enumerate(
+                    zip(whole, streamed, strict=True)
+                ):
+                    n = end if i == len(whole) - 1 else len(a)
+                    np.testing.assert_allclose(a[:n], b[:n], atol=1e-6)
+    finally:
+        cfg.STREAM_AUDIO, cfg.FILE_SPLITTING_DURATION, cfg.SIG_OVERLAP = saved
+
+
+def run_scale(tmp, n_files, minutes, args):
+    """Runs every step on one synthetic dataset and returns the timings."""
+    audio_dir = str(pathlib.Path(tmp) / "audio")
+    result_dir = str(pathlib.Path(tmp) / "results")
+    segment_dir = str(pathlib.Path(tmp) / "segments")
+    detection_dir = str(pathlib.Path(tmp) / "detections")
+    paths = make_dataset(audio_dir, n_files, minutes, args.format, args.sample_rate)
+    configure(result_dir, args.labels)
+    filesystem = fs.osfs.OSFS(audio_dir)
+    quiet = not args.verbose
+
+    timings = []
+
+    def analyse():
+        for path in paths:
+            analysefs.analyzeFile(path)
+
+    _, seconds = best_of(analyse, args.repeat, quiet)
+    timings.append(("analyse", seconds, n_files * minutes / 60, "audio h"))
+
+    matched, seconds = best_of(
+        lambda: parse_folders(filesystem, "/", result_dir), args.repeat, quiet
+    )
+    timings.append(("parse_folders", seconds, len(matched.pairs), "files"))
+
+    segments, seconds = best_of(
+        lambda: parse_files(matched.pairs, threshold=args.threshold), args.repeat, quiet
+    )
+    timings.append(("parse_files", seconds, len(segments), "segments"))
+
+    table = pa.Table.from_pylist(segments, schema=SEGMENT_SCHEMA)
+    write_detections([add_site_columns(table, cfg.SITE_PATTERN)], detection_dir)
+
+    sampled, seconds = best_of(
+        lambda: reservoir_sample(detection_dir, args.num_segments, seed=0),
+        args.repeat,
+        quiet,
+    )
+    timings.append(("reservoir_sample", seconds, len(segments), "segments"))
+
+    _, seconds = best_of(
+        lambda: stratified_sample(
+            detection_dir, args.num_segments, max_per_recording=2, seed=0
+        ),
+        args.repeat,
+        quiet,
+    )
+    timings.append(("stratified_sample", seconds, len(segments), "segments"))
+
+    # The audio folder stands in for the remote filesystem of the recordings
+    (_, saved, _), seconds = best_of(
+        lambda: extract_all(
+            sampled,
+            args.sample_rate,
+            segment_dir,
+            audio_dir,
+            workers=args.workers,
+        ),
+        args.repeat,
+        quiet,
+    )
+    timings.append(("extract_all", seconds, saved, "segments"))
+
+    filesystem.close()
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scales",
+        nargs="+",
+        default=["4x5", "16x5", "4x30"],
+        help="Data scales as FILESxMINUTES.",
+    )
+    parser.add_argument("--format", default="wav", help="wav or flac.")
+    parser.add_argument("--sample_rate", type=int, default=48000)
+    parser.add_argument("--labels", type=int, default=100, help="Number of labels.")
+    parser.add_argument("--threshold", type=float, default=0.6)
+    parser.add_argument("--num_segments", type=int, default=10)
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Processes of extract_all."
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="Best of N runs.")
+    parser.add_argument(
+        "--output", default=None, help="JSON-lines file the timings are appended to."
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="Show the output of the steps."
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        check_streaming(tmp, args.sample_rate)
+
+    print(f"{'scale':<10}{'step':<18}{'seconds':>10}{'items':>10}  {'per second':>12}")
+    for scale in args.scales:
+        n_files, minutes = scale.split("x")
+        n_files, minutes = int(n_files), float(minutes)
+        with tempfile.TemporaryDirectory() as tmp:
+            timings = run_scale(tmp, n_files, minutes, args)
+
+        for step, seconds, items, unit in timings:
+            rate = items / seconds if seconds else float("inf")
+            print(
+                f"{scale:<10}{step:<18}{seconds:>10.3f}{items:>10.4g}"
+                f"  {rate:>8.4g} {unit}/s"
+            )
+            if args.output:
+                append_jsonl(
+                    args.output,
+                    {
+                        "scale": scale,
+                        "format": args.format,
+                        "step": step,
+                        "seconds": round(seconds, 4),
+                        "items": items,
+                        "unit": unit,
+                    },
+                )
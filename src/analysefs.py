@@ -1,174 +1,348 @@
-import datetime
-import operator
+import argparse
+import logging
+import multiprocessing
 import os
 import pathlib
 import sys
 
 import config as cfg
+import numpy as np
+import postprocess
+from batching import BatchScheduler
 from birdnetsrc.analyze import (
     get_result_file_names,
-    getSortedTimestamps,
     loadCodes,
     predict,
 )
 from birdnetsrc.audio import splitSignal
-from birdnetsrc.utils import readLines, save_result_file
-from utils import read_audio_data
-
-RAVEN_TABLE_HEADER = "Selection\tView\tChannel\tBegin Time (s)\tEnd Time (s)\tLow Freq (Hz)\tHigh Freq (Hz)\tCommon Name\tSpecies Code\tConfidence\tBegin Path\tFile Offset (s)\n"
+from birdnetsrc.utils import readLines
+from labels import LabelRegistry
+from manifest import RunManifest, analysis_params, file_stat
+from metrics import FileMetrics, RunMetrics, append_jsonl
+from prefetch import Prefetcher
+from raven import frequency_range, write_raven_table
+from scores import save_scores, scores_path_for
+from silence import silent_chunks, silent_ranges
+from species_filter import species_mask_for
+from utils import read_audio_data, stream_audio_data
 
 
 def generate_raven_table(
-    timestamps: list[str],
-    result: dict[str, list],
+    detections: list[tuple],
     afile_path: str,
     result_path: str,
     sample_rate: int,
-) -> str:
-    selection_id = 0
-    out_string = RAVEN_TABLE_HEADER
-
-    # Read native sample rate
-    high_freq = sample_rate / 2
-
-    if high_freq > cfg.SIG_FMAX:
-        high_freq = cfg.SIG_FMAX
-
-    high_freq = min(high_freq, cfg.BANDPASS_FMAX)
-    low_freq = max(cfg.SIG_FMIN, cfg.BANDPASS_FMIN)
-    print(len(cfg.SPECIES_LIST))
-    # Extract valid predictions for every timestamp
-    for timestamp in timestamps:
-        rstring = ""
-        start, end = timestamp.split("-", 1)
-
-        for c in result[timestamp]:
-            if c[1] > cfg.MIN_CONFIDENCE and (
-                not cfg.SPECIES_LIST or c[0] in cfg.SPECIES_LIST
-            ):
-                selection_id += 1
-                label = cfg.TRANSLATED_LABELS[cfg.LABELS.index(c[0])]
-                code = cfg.CODES[c[0]] if c[0] in cfg.CODES else c[0]
-                rstring += f"{selection_id}\tSpectrogram 1\t1\t{start}\t{end}\t{low_freq}\t{high_freq}\t{label.split('_', 1)[-1]}\t{code}\t{c[1]:.4f}\t{afile_path}\t{start}\n"
-
-        # Write result string to file
-        out_string += rstring
-
-    # If we don't have any valid predictions, we still need to add a line to the selection table in case we want to combine results
-    # TODO: That's a weird way to do it, but it works for now. It would be better to keep track of file durations during the analysis.
-    if len(out_string) == len(RAVEN_TABLE_HEADER) and cfg.OUTPUT_PATH is not None:
-        selection_id += 1
-        out_string += f"{selection_id}\tSpectrogram 1\t1\t0\t3\t{low_freq}\t{high_freq}\tnocall\tnocall\t1.0\t{afile_path}\t0\n"
-
-    print(f"FILE SAVED IN {result_path}")
-    save_result_file(result_path, out_string)
+):
+    low_freq, high_freq = frequency_range(
+        sample_rate, cfg.SIG_FMIN, cfg.SIG_FMAX, cfg.BANDPASS_FMIN, cfg.BANDPASS_FMAX
+    )
+    write_raven_table(
+        detections,
+        cfg.LABEL_REGISTRY,
+        afile_path,
+        result_path,
+        low_freq,
+        high_freq,
+        add_nocall=cfg.OUTPUT_PATH is not None,
+    )
+    logging.info(f"File saved in {result_path}")
+
+
+def setup_logging():
+    """Logs the progress of the analysis to stderr."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+
+def get_detections(
+    scores: np.ndarray, timestamps: list[list], fpath=None
+) -> list[tuple]:
+    """Applies the confidence threshold, species filters and top-k to the scores.
+
+    Args:
+        scores: Array of shape (n_chunks, n_labels) returned by ``predict``.
+        timestamps: The [start, end] of every chunk.
+        fpath: Path of the recording, used by the location/week filter.
+
+    Returns:
+        A list of (start, end, label index, confidence) tuples.
+    """
+    return postprocess.get_detections(
+        scores,
+        timestamps,
+        cfg.MIN_CONFIDENCE,
+        mask=species_mask_for(fpath),
+        top_k=cfg.TOP_K,
+    )
 
 
 def saveResultFiles(
-    r: dict[str, list], result_files: dict[str, str], afile_path: str, sample_rate: int
+    detections: list[tuple],
+    result_files: dict[str, str],
+    afile_path: str,
+    sample_rate: int,
 ):
     """Saves the results to the hard drive.
 
     Args:
-        r: The dictionary with {segment: scores}.
-        path: The path where the result should be saved.
+        detections: The (start, end, label index, confidence) detections.
+        result_files: The paths where the results should be saved.
         afile_path: The path to audio file.
     """
 
     os.makedirs(cfg.OUTPUT_PATH, exist_ok=True)
 
-    # Selection table
-    timestamps = getSortedTimestamps(r)
-
     if "table" in result_files:
-        generate_raven_table(
-            timestamps, r, afile_path, result_files["table"], sample_rate
-        )
+        generate_raven_table(detections, afile_path, result_files["table"], sample_rate)
 
 
-def analyzeFile(fpath: pathlib.Path):
-    """Analyzes a file.
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "NUMBA_NUM_THREADS",
+    "TF_NUM_INTRAOP_THREADS",
+    "TF_NUM_INTEROP_THREADS",
+]
 
-    Predicts the scores for the file and saves the results.
+_manifest = None
 
-    Args:
-        item: Tuple containing (file path, config)
 
-    Returns:
-        The True if the file was analyzed successfully.
+def get_manifest():
+    """The run manifest of this process, opened on first use."""
+    global _manifest
+    if _manifest is None:
+        _manifest = RunManifest(cfg.MANIFEST_FILE)
+    return _manifest
+
+
+def skip_analysed(fpaths):
+    """Yields the paths whose results in the run manifest are not current."""
+    params = analysis_params(cfg.SPECIES_LIST)
+    for fpath in fpaths:
+        try:
+            current = get_manifest().is_current(fpath, *file_stat(fpath), params)
+        except Exception:
+            current = False
+        if current:
+            logging.info(f"Skipping {fpath}, results are up to date")
+        else:
+            yield fpath
+
+
+def iter_audio_windows(fpath, metrics=None):
+    """Yields the audio of a file as ``(offset, wave)`` windows.
+
+    Without ``cfg.STREAM_AUDIO`` the whole file is a single window. Otherwise
+    windows are a whole number of chunk steps long so that chunk boundaries
+    and timestamps continue seamlessly from one window to the next.
     """
+    if not cfg.STREAM_AUDIO:
+        wave, _sr, _duration = read_audio_data(
+            fpath, sr=cfg.SAMPLE_RATE, metrics=metrics
+        )
+        yield 0.0, wave
+        return
+
+    step = cfg.SIG_LENGTH - cfg.SIG_OVERLAP
+    window = max(1, int(cfg.FILE_SPLITTING_DURATION // step)) * step
+    yield from stream_audio_data(
+        fpath, cfg.SAMPLE_RATE, window, cfg.SIG_OVERLAP, metrics=metrics
+    )
+
+
+def iter_chunks(fpath, audio=None, metrics=None):
+    """Yields the model inputs of a file as ``(chunk, [start, end], silent)``.
+
+    ``silent`` is True for chunks below ``cfg.SILENCE_THRESHOLD_DB`` when the
+    silence gate is enabled, the model is not run on them.
 
-    # Start time
-    start_time = datetime.datetime.now()
-    #offset = 0
-    #duration = cfg.FILE_SPLITTING_DURATION
+    Args:
+        fpath: Path or fsspec URL of the audio file.
+        audio: Optional already decoded ``(offset, wave)`` windows of the file,
+            read from ``fpath`` if not given.
+        metrics: Optional ``FileMetrics`` receiving the split time and the
+            chunk counts.
+    """
+    metrics = metrics or FileMetrics(fpath)
+    step = cfg.SIG_LENGTH - cfg.SIG_OVERLAP
     start, end = 0, cfg.SIG_LENGTH
-    results = {}
-    result_file_name = get_result_file_names(fpath)
 
-    # Open file and split into chunks:
-    wave, sr, fileLengthSeconds = read_audio_data(fpath, sr=cfg.SAMPLE_RATE)
+    if audio is None:
+        audio = iter_audio_windows(fpath, metrics)
 
-    # Status
-    print(f"Analyzing {fpath}", flush=True)
+    for offset, wave in audio:
+        if offset > 0 and len(wave) < int(cfg.SIG_MINLEN * cfg.SAMPLE_RATE):
+            # Whole-file splitting only pads the first chunk of the file, a
+            # short last window holds no further chunk
+            continue
+        with metrics.stage("split"):
+            chunks = splitSignal(
+                wave, cfg.SAMPLE_RATE, cfg.SIG_LENGTH, cfg.SIG_OVERLAP, cfg.SIG_MINLEN
+            )
+            if cfg.STREAM_AUDIO:
+                # The overlap tail of a window is the head of the next one
+                chunks = chunks[: max(1, int(cfg.FILE_SPLITTING_DURATION // step))]
+
+            if cfg.SILENCE_GATE:
+                silent = silent_chunks(
+                    chunks,
+                    cfg.SAMPLE_RATE,
+                    cfg.SILENCE_GATE,
+                    cfg.SILENCE_THRESHOLD_DB,
+                    cfg.BANDPASS_FMIN,
+                    cfg.BANDPASS_FMAX,
+                ).tolist()
+            else:
+                silent = [False] * len(chunks)
+
+        metrics.counters["audio_seconds"] = max(
+            metrics.counters["audio_seconds"], offset + len(wave) / cfg.SAMPLE_RATE
+        )
+        metrics.count("chunks", len(chunks))
+        metrics.count("skipped_chunks", sum(silent))
 
-    # Process each chunk
-    #while offset < fileLengthSeconds:
-    chunks = splitSignal(wave, sr, cfg.SIG_LENGTH, cfg.SIG_OVERLAP, cfg.SIG_MINLEN)
-    print(len(chunks))
-    samples = []
+        for chunk, is_silent in zip(chunks, silent, strict=True):
+            yield chunk, [start, end], is_silent
+
+            # Advance start and end
+            start += step
+            end = start + cfg.SIG_LENGTH
+
+
+def predict_chunks(chunks, metrics=None):
+    """Predicts ``(chunk, timestamp, silent)`` in batches of ``cfg.BATCH_SIZE``.
+
+    Silent chunks are not predicted, their scores are 0. The time spent in
+    ``predict`` is added to the ``predict`` stage of ``metrics``.
+
+    Returns:
+        The (n_chunks, n_labels) score matrix, the chunk timestamps and the
+        boolean mask of the skipped chunks.
+    """
+    metrics = metrics or FileMetrics(None)
+    scores = []
     timestamps = []
+    skipped = []
+    samples = []
+
+    for chunk, timestamp, silent in chunks:
+        timestamps.append(timestamp)
+        skipped.append(silent)
+        if silent:
+            continue
 
-    for chunk_index, chunk in enumerate(chunks):
-        print(chunk_index)
         # Add to batch
         samples.append(chunk)
-        timestamps.append([start, end])
 
-        # Advance start and end
-        start += cfg.SIG_LENGTH - cfg.SIG_OVERLAP
-        end = start + cfg.SIG_LENGTH
+        # Predict once the batch is full
+        if len(samples) == cfg.BATCH_SIZE:
+            with metrics.stage("predict"):
+                scores.append(np.asarray(predict(samples), dtype=np.float32))
+            samples = []
 
-        print(start)
+    # Predict the last, incomplete batch
+    if samples:
+        with metrics.stage("predict"):
+            scores.append(np.asarray(predict(samples), dtype=np.float32))
+
+    skipped = np.array(skipped, dtype=bool)
+    return expand_scores(scores, skipped), timestamps, skipped
 
-        # Check if batch is full or last chunk
-        if len(samples) < cfg.BATCH_SIZE and chunk_index < len(chunks) - 1:
-            continue
 
-        # Predict
-        p = predict(samples)
+def expand_scores(scores, skipped):
+    """Stacks predicted score rows into the full matrix, 0 for skipped chunks."""
+    full = np.zeros((len(skipped), len(cfg.LABELS)), dtype=np.float32)
+    if scores:
+        full[~skipped] = np.concatenate(scores)
+    return full
 
-        # Add to results
-        for i in range(len(samples)):
-            # Get timestamp
-            s_start, s_end = timestamps[i]
 
-            # Get prediction
-            pred = p[i]
+def save_file_results(fpath, scores, timestamps, metrics, skipped=None):
+    """Post-processes and saves the scores of a file, then records it as done.
+
+    Returns:
+        The metrics record of the file, also appended to ``cfg.METRICS_FILE``.
+    """
+    result_file_name = get_result_file_names(fpath)
+
+    with metrics.stage("write"):
+        if cfg.SAVE_SCORES and "table" in result_file_name:
+            save_scores(
+                scores_path_for(result_file_name["table"]),
+                scores,
+                timestamps,
+                fpath,
+                cfg.MODEL_VERSION,
+                cfg.SAMPLE_RATE,
+                dtype=cfg.SCORES_DTYPE,
+                floor=cfg.SCORES_FLOOR,
+                skipped=skipped,
+            )
+
+    with metrics.stage("postprocess"):
+        detections = get_detections(scores, timestamps, fpath)
+
+    with metrics.stage("write"):
+        saveResultFiles(detections, result_file_name, fpath, cfg.SAMPLE_RATE)
+
+        if cfg.MANIFEST_FILE:
+            get_manifest().record(
+                fpath,
+                *file_stat(fpath),
+                analysis_params(cfg.SPECIES_LIST),
+                result_file_name.get("table"),
+            )
+
+    record = metrics.finish()
+    if cfg.SILENCE_GATE and skipped is not None:
+        # Tells the gated ranges apart from analysed ranges without detection
+        record["silent_ranges"] = silent_ranges(timestamps, skipped)
+    if cfg.METRICS_FILE:
+        append_jsonl(cfg.METRICS_FILE, {"type": "file", **record})
+
+    status = f"{record['realtime_factor']}x realtime"
+    if cfg.SILENCE_GATE:
+        status += f", {record['skipped_chunks']} of {record['chunks']} chunks silent"
+    logging.info(f"Finished {fpath} in {record['wall_s']:.2f} seconds ({status})")
+    return record
+
+
+def analyzeFile(fpath: pathlib.Path, audio=None, metrics=None):
+    """Analyzes a file.
 
-            # Assign scores to labels
-            p_labels = zip(cfg.LABELS, pred, strict=False)
+    Predicts the scores for the file and saves the results.
 
-            # Sort by score
-            p_sorted = sorted(p_labels, key=operator.itemgetter(1), reverse=True)
+    Args:
+        fpath: Path or fsspec URL of the audio file.
+        audio: Optional already decoded ``(offset, wave)`` windows of the file,
+            read from ``fpath`` if not given.
+        metrics: Optional ``FileMetrics`` of the file, e.g. started when it
+            was prefetched.
 
-            # Store top 5 results and advance indices
-            results[str(s_start) + "-" + str(s_end)] = p_sorted
+    Returns:
+        The metrics record of the file.
+    """
+    metrics = metrics or FileMetrics(fpath)
 
-        # Clear batch
-        samples = []
-        timestamps = []
-        #offset = offset + duration
+    # Status
+    logging.info(f"Analyzing {fpath}")
 
-    saveResultFiles(results, result_file_name, fpath, cfg.SAMPLE_RATE)
-    delta_time = (datetime.datetime.now() - start_time).total_seconds()
-    print(f"Finished {fpath} in {delta_time:.2f} seconds", flush=True)
-    print(f"OUTPUT file saved in {result_file_name}")
+    scores, timestamps, skipped = predict_chunks(
+        iter_chunks(fpath, audio, metrics), metrics
+    )
+    return save_file_results(fpath, scores, timestamps, metrics, skipped)
 
-    return True
 
+def load_runtime():
+    """Resolves model paths and loads labels, codes and the species list.
 
-if __name__ == "__main__":
+    Called once per process so that a worker analysing many files keeps
+    them, and the TFLite interpreter loaded on the first ``predict``, warm.
+    """
     # Set paths relative to script path (requested in #3)
     script_dir = pathlib.Path(sys.argv[0]).parent.absolute() / "birdnetsrc"
     cfg.MODEL_PATH = os.path.join(script_dir, cfg.MODEL_PATH)
@@ -186,7 +360,282 @@ if __name__ == "__main__":
 
     cfg.SPECIES_LIST_FILE = pathlib.Path() / "species_list.txt"
     cfg.SPECIES_LIST = readLines(cfg.SPECIES_LIST_FILE)
-    print(f"Species list contains {len(cfg.SPECIES_LIST)} species")
+    logging.info(f"Species list contains {len(cfg.SPECIES_LIST)} species")
+
+    cfg.LABEL_REGISTRY = LabelRegistry(
+        cfg.LABELS, cfg.TRANSLATED_LABELS, cfg.CODES, cfg.SPECIES_LIST
+    )
+
+
+def iter_file_paths(files, file_list=None, queue=None):
+    """Yields the paths to analyse from every configured source.
+
+    Args:
+        files: Paths given on the command line, ``-`` reads paths from stdin.
+        file_list: Optional text/csv file with one path per line.
+        queue: Optional local queue (e.g. ``multiprocessing.Queue``), consumed
+            until a ``None`` sentinel is received.
+    """
+    for fpath in files:
+        if fpath == "-":
+            yield from (line.strip() for line in sys.stdin if line.strip())
+        else:
+            yield fpath
+
+    if file_list:
+        with pathlib.Path(file_list).open() as fl:
+            yield from (line.strip() for line in fl if line.strip())
+
+    if queue is not None:
+        while (fpath := queue.get()) is not None:
+            yield fpath
+
+
+def load_audio(fpath):
+    """Fetches and decodes a whole file, used by the prefetch pipeline.
+
+    Returns:
+        The ``(offset, wave)`` windows of the file and its ``FileMetrics``.
+    """
+    metrics = FileMetrics(fpath)
+    return list(iter_audio_windows(fpath, metrics)), metrics
+
+
+def _loaded_nbytes(data):
+    windows, _metrics = data
+    return sum(wave.nbytes for _offset, wave in windows)
+
+
+def report_run(run_metrics):
+    """Logs the run summary and appends it to ``cfg.METRICS_FILE``."""
+    summary = run_metrics.close()
+    shares = summary["stages_share"]
+    stages = ", ".join(f"{name} {share:.0%}" for name, share in shares.items() if share)
+    logging.info(
+        f"Analysed {summary['audio_hours']:.2f} h of audio in"
+        f" {summary['elapsed_s']:.1f} seconds"
+        f" ({summary['realtime_factor']}x realtime): {stages}"
+    )
+    if cfg.SILENCE_GATE and summary["chunks"]:
+        logging.info(
+            f"Silence gate skipped {summary['skipped_chunks']} of {summary['chunks']}"
+            f" chunks ({summary['skipped_fraction']:.1%})"
+        )
+
+
+def log_error(fpath, e, run_metrics=None):
+    if run_metrics is not None:
+        run_metrics.fail()
+    logging.error(f"Error analyzing {fpath}: {e}")
+    with pathlib.Path(cfg.ERROR_LOG_FILE).open("a") as elog:
+        elog.write(f"{fpath}\t{e!r}\n")
+
+
+def run_worker(fpaths, prefetch=0):
+    """Analyses every file in ``fpaths`` within the current process.
 
-    filename = sys.argv[1]
-    analyzeFile(filename)
+    With ``cfg.SKIP_EXISTING_RESULTS``, files that are up to date in the run
+    manifest are skipped. With ``prefetch`` > 0 the next files are fetched and
+    decoded in background threads while the current one is analysed. With
+    ``cfg.BATCH_ACROSS_FILES``, batches are filled with chunks from several
+    files. A failing file is logged to ``cfg.ERROR_LOG_FILE`` and does not
+    stop the worker.
+
+    Returns:
+        The ``RunMetrics`` of the analysed files.
+    """
+    run_metrics = RunMetrics(cfg.METRICS_FILE)
+
+    if cfg.SKIP_EXISTING_RESULTS and cfg.MANIFEST_FILE:
+        fpaths = skip_analysed(fpaths)
+
+    if prefetch and cfg.STREAM_AUDIO:
+        logging.warning("Prefetching is disabled when streaming audio")
+        prefetch = 0
+
+    if prefetch:
+        items = Prefetcher(
+            fpaths,
+            load_audio,
+            depth=prefetch,
+            max_bytes=cfg.PREFETCH_MAX_MB * 1024 * 1024,
+            sizeof=_loaded_nbytes,
+        )
+    else:
+        items = ((fpath, (None, None), None) for fpath in fpaths)
+
+    if cfg.BATCH_ACROSS_FILES and not cfg.STREAM_AUDIO:
+        _run_batched(items, run_metrics)
+        return run_metrics
+
+    for fpath, data, error in items:
+        if error is not None:
+            log_error(fpath, error, run_metrics)
+            continue
+        try:
+            run_metrics.add(analyzeFile(fpath, *data))
+        except Exception as e:
+            log_error(fpath, e, run_metrics)
+
+    return run_metrics
+
+
+def _run_batched(items, run_metrics):
+    """Analyses files with batches packed from the chunks of several files."""
+
+    def on_done(key, scores, context, predict_seconds):
+        fpath, timestamps, metrics, skipped = context
+        metrics.add_time("predict", predict_seconds)
+        try:
+            scores = expand_scores([scores], skipped)
+            run_metrics.add(
+                save_file_results(fpath, scores, timestamps, metrics, skipped)
+            )
+        except Exception as e:
+            log_error(fpath, e, run_metrics)
+
+    scheduler = BatchScheduler(
+        lambda samples: np.asarray(predict(samples), dtype=np.float32),
+        cfg.BATCH_SIZE,
+        len(cfg.LABELS),
+        on_done,
+        on_error=lambda key, e: log_error(key[1], e, run_metrics),
+        timeout=cfg.BATCH_TIMEOUT,
+    )
+
+    for key, (fpath, data, error) in enumerate(items):
+        if error is not None:
+            log_error(fpath, error, run_metrics)
+            continue
+        try:
+            audio, metrics = data
+            metrics = metrics or FileMetrics(fpath)
+            logging.info(f"Analyzing {fpath}")
+            chunks, timestamps, skipped = [], [], []
+            for chunk, timestamp, silent in iter_chunks(fpath, audio, metrics):
+                if not silent:
+                    chunks.append(chunk)
+                timestamps.append(timestamp)
+                skipped.append(silent)
+        except Exception as e:
+            log_error(fpath, e, run_metrics)
+            continue
+        scheduler.add(
+            (key, fpath),
+            chunks,
+            (fpath, timestamps, metrics, np.array(skipped, dtype=bool)),
+        )
+
+    scheduler.close()
+
+
+def _init_pool_worker(config, cpu_sets):
+    """Pool initializer: restores the config and pins the worker to its CPUs."""
+    setup_logging()
+    cfg.setConfig(config)
+    cfg.LABEL_REGISTRY = LabelRegistry(
+        cfg.LABELS, cfg.TRANSLATED_LABELS, cfg.CODES, cfg.SPECIES_LIST
+    )
+    if cpu_sets is not None:
+        os.sched_setaffinity(0, cpu_sets.get())
+
+
+def _analyze_in_pool(fpath):
+    try:
+        return fpath, None, analyzeFile(fpath)
+    except Exception as e:
+        return fpath, e, None
+
+
+def run_pool(fpaths, n_workers):
+    """Analyses files with a pool of worker processes.
+
+    Every worker owns one TFLite interpreter with ``cfg.TFLITE_THREADS``
+    threads and the number of workers is capped so that all of them together
+    use at most ``cfg.CPU_THREADS`` threads. Idle workers take the next file
+    from a shared queue. With ``cfg.PIN_WORKERS`` each worker is bound to its
+    own set of CPUs. Workers analyse one file at a time, without
+    prefetching or ``cfg.BATCH_ACROSS_FILES``.
+
+    Returns:
+        The ``RunMetrics`` of the analysed files.
+    """
+    run_metrics = RunMetrics(cfg.METRICS_FILE)
+    threads = max(1, cfg.TFLITE_THREADS)
+    max_workers = max(1, cfg.CPU_THREADS // threads)
+    n_workers = min(n_workers or max_workers, max_workers)
+
+    # Keep numpy, librosa and numba from starting their own thread pools in
+    # every worker on top of the TFLite threads
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = "1"
+
+    ctx = multiprocessing.get_context("spawn")
+    cpu_sets = None
+    if cfg.PIN_WORKERS:
+        cpus = sorted(os.sched_getaffinity(0))
+        cpu_sets = ctx.Queue()
+        for i in range(n_workers):
+            cpu_sets.put(set(cpus[i * threads : (i + 1) * threads] or cpus))
+
+    if cfg.SKIP_EXISTING_RESULTS and cfg.MANIFEST_FILE:
+        fpaths = skip_analysed(fpaths)
+
+    logging.info(f"Analysing with {n_workers} workers of {threads} threads")
+    with ctx.Pool(
+        n_workers,
+        initializer=_init_pool_worker,
+        initargs=(cfg.getConfig(), cpu_sets),
+    ) as pool:
+        for fpath, error, record in pool.imap_unordered(_analyze_in_pool, fpaths):
+            if error is None:
+                run_metrics.add(record)
+            else:
+                log_error(fpath, error, run_metrics)
+
+    return run_metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="Audio files to analyse, use - to read paths from stdin.",
+    )
+    parser.add_argument(
+        "--file_list", default=None, help="File listing one audio path per line."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes, 0 uses CPU_THREADS / TFLITE_THREADS. "
+        "Prefetching and BATCH_ACROSS_FILES only apply to a single worker.",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=cfg.PREFETCH_DEPTH,
+        help="Number of files fetched and decoded ahead of the analysis, "
+        "single worker only.",
+    )
+    args = parser.parse_args()
+
+    setup_logging()
+    if args.workers != 1 and (args.prefetch or cfg.BATCH_ACROSS_FILES):
+        logging.warning(
+            f"Prefetching and BATCH_ACROSS_FILES are ignored with --workers "
+            f"{args.workers}, run one worker per process to use them"
+        )
+    load_runtime()
+    fpaths = iter_file_paths(args.files, args.file_list)
+    if args.workers == 1:
+        run_metrics = run_worker(fpaths, args.prefetch)
+    else:
+        run_metrics = run_pool(fpaths, args.workers)
+    logging.info(f"Worker finished, {run_metrics.files} files analysed")
+    report_run(run_metrics)
+    # A batch of files handed over by GNU parallel fails if any of its files
+    # failed, so that --resume-failed runs it again
+    sys.exit(1 if run_metrics.failed else 0)
@@ -0,0 +1,246 @@
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import os
+import pathlib
+import shutil
+import urllib.parse
+
+import config as cfg
+from connections import open_remote
+
+LOCAL_PROTOCOLS = ("", "file", "local")
+
+
+def cache_key(url):
+    """Location of a remote file without protocol chain, credentials or port.
+
+    ``filecache::ssh://user:pw@host:/data/a.wav`` and
+    ``ssh://other@HOST/data/a.wav`` both give ``host/data/a.wav``, so that
+    the analysis (fsspec URLs) and ``extract.py`` (connection string and
+    path) share the cached copy of a recording.
+    """
+    parts = urllib.parse.urlsplit(str(url).split("::")[-1])
+    return f"{parts.hostname or ''}{parts.path}"
+
+
+def is_remote(url):
+    url = str(url).split("::")[-1]
+    return "://" in url and urllib.parse.urlsplit(url).scheme not in LOCAL_PROTOCOLS
+
+
+class AudioCache:
+    """Size-capped local copy of remote recordings, shared by processes.
+
+    Each recording is downloaded once into ``directory`` and then opened
+    from there. A per-file lock makes concurrent workers wait for a running
+    download instead of starting their own. Once the cache grows over
+    ``max_bytes``, the least recently used recordings are evicted, except
+    pinned ones (e.g. recordings queued for extraction).
+
+    Args:
+        directory: Cache directory, created if needed.
+        max_bytes: Size cap of the cached recordings.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = pathlib.Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, url):
+        key = cache_key(url)
+        digest = hashlib.sha1(key.encode()).hexdigest()  # noqa: S324
+        ext = pathlib.PurePosixPath(key).suffix.lower()
+        return self.directory / digest[:2] / (digest + ext)
+
+    def open(self, url, download=None):
+        """Opens the cached copy of ``url``, downloading it first if needed.
+
+        Args:
+            url: fsspec URL of the recording, also used as cache key.
+            download: Optional function writing the recording to the binary
+                file it is given, defaults to reading ``url`` with fsspec (or
+                the SSH connection pool).
+
+        Returns:
+            A binary file object. It stays readable even if the recording
+            is evicted while it is open.
+        """
+        path = self.path_for(url)
+        with contextlib.suppress(FileNotFoundError):
+            return self._open_cached(path)
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with _locked(_sibling(path, ".lock")):
+            # Another worker may have downloaded it while we waited
+            with contextlib.suppress(FileNotFoundError):
+                return self._open_cached(path)
+
+            part = _sibling(path, f".{os.getpid()}.part")
+            try:
+                with part.open("wb") as dst:
+                    if download is None:
+                        with open_remote(url) as src:
+                            shutil.copyfileobj(src, dst, 1024 * 1024)
+                    else:
+                        download(dst)
+                part.replace(path)
+            finally:
+                part.unlink(missing_ok=True)
+            f = path.open("rb")
+
+        self.evict()
+        return f
+
+    def _open_cached(self, path):
+        f = path.open("rb")
+        # The modification time orders the recordings for LRU eviction
+        os.utime(path)
+        return f
+
+    def contains(self, url):
+        return self.path_for(url).exists()
+
+    def pin(self, url):
+        """Protects a recording from eviction, even if it is not cached yet."""
+        path = self.path_for(url)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _sibling(path, ".pin").write_text(str(url))
+
+    def unpin(self, url):
+        _sibling(self.path_for(url), ".pin").unlink(missing_ok=True)
+
+    def is_pinned(self, path):
+        return _sibling(path, ".pin").exists()
+
+    def entries(self):
+        """(mtime, size, path) of every cached recording."""
+        entries = []
+        for path in self.directory.glob("*/*"):
+            if path.name.endswith((".lock", ".pin", ".part")):
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                st = path.stat()
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        """Deletes the least recently used recordings until the cache fits."""
+        with _locked(self.directory / ".evict.lock"):
+            entries = self.entries()
+            total = sum(size for _mtime, size, _path in entries)
+            for _mtime, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if self.is_pinned(path):
+                    continue
+                # Under the entry's lock, so that no worker is reading the
+                # lock file's inode when it goes away with the recording
+                lock = _sibling(path, ".lock")
+                with _locked(lock):
+                    with contextlib.suppress(FileNotFoundError):
+                        path.unlink()
+                        total -= size
+                    lock.unlink()
+        return total
+
+
+def _sibling(path, suffix):
+    """``path`` with ``suffix`` appended to its name, e.g. its lock file."""
+    return path.with_name(path.name + suffix)
+
+
+@contextlib.contextmanager
+def _locked(path):
+    """Exclusive lock on ``path``, which may be removed by its holder.
+
+    A waiter that gets the lock after the file was removed (or replaced by
+    a new lock file) holds a stale inode, so it retries on the current one.
+    """
+    while True:
+        with path.open("a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                try:
+                    current = path.stat().st_ino
+                except FileNotFoundError:
+                    current = None
+                if current != os.fstat(f.fileno()).st_ino:
+                    continue
+                yield
+                return
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+_caches = {}
+
+
+def get_audio_cache():
+    """The cache configured by ``cfg.AUDIO_CACHE_DIR``, None if disabled."""
+    if not cfg.AUDIO_CACHE_DIR:
+        return None
+    key = (cfg.AUDIO_CACHE_DIR, cfg.AUDIO_CACHE_MAX_GB)
+    if key not in _caches:
+        _caches[key] = AudioCache(
+            cfg.AUDIO_CACHE_DIR, int(cfg.AUDIO_CACHE_MAX_GB * 1024**3)
+        )
+    return _caches[key]
+
+
+def open_audio(url, download=None):
+    """Opens a recording, through the audio cache when it is remote."""
+    cache = get_audio_cache()
+    if cache is not None and is_remote(url):
+        return cache.open(url, download)
+    if download is not None:
+        raise ValueError(f"No audio cache configured to download {url}")
+    return open_remote(url)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the local audio cache.")
+    parser.add_argument("action", choices=["pin", "unpin", "info", "evict"])
+    parser.add_argument(
+        "file_list", nargs="?", help="File listing one audio path per line."
+    )
+    parser.add_argument(
+        "--prefix",
+        default="",
+        help="Connection string prepended to the paths, e.g. ssh://USER@HOST",
+    )
+    parser.add_argument("--cache_dir", default=cfg.AUDIO_CACHE_DIR)
+    parser.add_argument("--max_gb", type=float, default=cfg.AUDIO_CACHE_MAX_GB)
+    args = parser.parse_args()
+
+    if not args.cache_dir:
+        parser.error("No cache directory, set AUDIO_CACHE_DIR or --cache_dir")
+    cache = AudioCache(args.cache_dir, int(args.max_gb * 1024**3))
+
+    if args.action in ("pin", "unpin"):
+        if not args.file_list:
+            parser.error(f"{args.action} needs a file list")
+        with pathlib.Path(args.file_list).open() as fl:
+            paths = [line.strip() for line in fl if line.strip()]
+        urls = [
+            f"{args.prefix.rstrip('/')}/{path.lstrip('/')}" if args.prefix else path
+            for path in paths
+        ]
+        for url in urls:
+            if args.action == "pin":
+                cache.pin(url)
+            else:
+                cache.unpin(url)
+        print(f"{args.action}: {len(urls)} recordings")
+    elif args.action == "evict":
+        print(f"Cache holds {cache.evict() / 1024**3:.2f} GB after eviction")
+    else:
+        entries = cache.entries()
+        pinned = sum(cache.is_pinned(path) for *_, path in entries)
+        size = sum(size for _mtime, size, _path in entries)
+        print(
+            f"{len(entries)} recordings ({pinned} pinned), {size / 1024**3:.2f} of"
+            f" {args.max_gb:.2f} GB"
+        )
@@ -0,0 +1,128 @@
+import threading
+import time
+
+import numpy as np
+
+
+class BatchScheduler:
+    """Packs chunks from several files into full, fixed-size model batches.
+
+    Chunks are queued in arrival order and sent to ``predict`` as soon as
+    ``batch_size`` of them are waiting. A partial batch is flushed once its
+    oldest chunk has waited ``timeout`` seconds, so latency stays bounded
+    when files arrive slowly. Scores are routed back to their file, and
+    ``on_done(key, scores, context, predict_seconds)`` is called once all
+    chunks of a file are predicted. ``predict_seconds`` is the file's share
+    of the batches it was part of, by number of chunks.
+
+    Args:
+        predict: Function mapping a list of chunks to an array of scores.
+        batch_size: Number of chunks per batch.
+        n_labels: Number of model outputs, used for files without chunks.
+        on_done: Called with the file key, its (n_chunks, n_labels) scores,
+            the context passed to ``add`` and its prediction time.
+        on_error: Called with the file key and the exception when a batch
+            containing chunks of that file fails.
+        timeout: Seconds after which a partial batch is flushed, None to
+            only flush full batches and on ``close``.
+    """
+
+    def __init__(
+        self, predict, batch_size, n_labels, on_done, on_error=None, timeout=None
+    ):
+        self.predict = predict
+        self.batch_size = max(1, batch_size)
+        self.n_labels = n_labels
+        self.on_done = on_done
+        self.on_error = on_error
+        self.timeout = timeout
+
+        self._lock = threading.RLock()
+        self._pending = []  # (key, chunk index, chunk)
+        self._oldest = None
+        self._files = {}
+        self._closed = threading.Event()
+        self._timer = None
+        if timeout:
+            self._timer = threading.Thread(target=self._flush_on_timeout, daemon=True)
+            self._timer.start()
+
+    def add(self, key, chunks, context=None):
+        """Queues all chunks of a file and runs every batch that is full."""
+        with self._lock:
+            if not len(chunks):
+                self.on_done(
+                    key, np.empty((0, self.n_labels), dtype=np.float32), context, 0.0
+                )
+                return
+
+            self._files[key] = {
+                "scores": None,
+                "remaining": len(chunks),
+                "context": context,
+                "predict_seconds": 0.0,
+            }
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._pending.extend((key, i, chunk) for i, chunk in enumerate(chunks))
+
+            while len(self._pending) >= self.batch_size:
+                self._run_batch(self.batch_size)
+
+    def flush(self):
+        """Predicts all waiting chunks, even if they do not fill a batch."""
+        with self._lock:
+            while self._pending:
+                self._run_batch(self.batch_size)
+
+    def close(self):
+        self._closed.set()
+        self.flush()
+        if self._timer is not None:
+            self._timer.join()
+
+    def _flush_on_timeout(self):
+        while not self._closed.wait(self.timeout / 4):
+            with self._lock:
+                if (
+                    self._oldest is not None
+                    and time.monotonic() - self._oldest >= self.timeout
+                ):
+                    self.flush()
+
+    def _run_batch(self, size):
+        batch, self._pending = self._pending[:size], self._pending[size:]
+        self._oldest = time.monotonic() if self._pending else None
+
+        t0 = time.perf_counter()
+        try:
+            scores = np.asarray(self.predict([chunk for *_, chunk in batch]))
+        except Exception as e:
+            for key in dict.fromkeys(key for key, *_ in batch):
+                self._fail(key, e)
+            return
+        seconds_per_chunk = (time.perf_counter() - t0) / len(batch)
+
+        for (key, i, _chunk), score in zip(batch, scores, strict=True):
+            entry = self._files.get(key)
+            if entry is None:
+                continue
+            if entry["scores"] is None:
+                # Chunks are predicted in order, the first one seen is chunk 0
+                entry["scores"] = np.empty(
+                    (entry["remaining"], scores.shape[1]), dtype=np.float32
+                )
+            entry["scores"][i] = score
+            entry["remaining"] -= 1
+            entry["predict_seconds"] += seconds_per_chunk
+            if entry["remaining"] == 0:
+                del self._files[key]
+                self.on_done(
+                    key, entry["scores"], entry["context"], entry["predict_seconds"]
+                )
+
+    def _fail(self, key, e):
+        self._files.pop(key, None)
+        self._pending = [item for item in self._pending if item[0] != key]
+        if self.on_error is not None:
+            self.on_error(key, e)
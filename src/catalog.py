@@ -0,0 +1,271 @@
+import argparse
+import concurrent.futures
+import contextlib
+import fnmatch
+import logging
+import pathlib
+import posixpath
+import sqlite3
+import threading
+import time
+
+import yaml
+from connections import ConnectionPool, get_pool
+
+AUDIO_PATTERNS = ["*.wav", "*.flac", "*.mp3", "*.ogg", "*.m4a", "*.WAV", "*.MP3"]
+
+
+class FileCatalog:
+    """SQLite catalog of the files of a (remote) directory tree.
+
+    ``refresh`` lists the directories concurrently and records the path,
+    size, modification time and extension of every file. On later refreshes
+    only the directories whose modification time changed are listed again,
+    unchanged ones cost a single ``getinfo`` per subdirectory.
+
+    Adding or removing a file changes the modification time of its
+    directory, overwriting a file in place does not: use ``full=True`` to
+    list everything again.
+
+    Args:
+        path: Path of the SQLite database, created if needed.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute(
+            """CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY,
+                parent TEXT,
+                mtime REAL,
+                listed REAL
+            )"""
+        )
+        self.con.execute(
+            """CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                dir TEXT,
+                size INTEGER,
+                mtime REAL,
+                ext TEXT
+            )"""
+        )
+        self.con.execute("CREATE INDEX IF NOT EXISTS files_dir ON files (dir)")
+        self.con.execute("CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)")
+
+    def refresh(self, filesystem, root="/", workers=8, full=False):
+        """Brings the catalog of ``root`` up to date with the filesystem.
+
+        Args:
+            filesystem: ``fs`` filesystem or ``connections.ConnectionPool``.
+            root: Directory to catalog.
+            workers: Number of directories listed concurrently.
+            full: List every directory, even if its mtime did not change.
+
+        Returns:
+            The number of directories listed and the number left unchanged.
+        """
+        root = posixpath.normpath("/" + root.strip("/"))
+        listed = skipped = 0
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            pending = {executor.submit(self._visit, filesystem, root, None, None, full)}
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    was_listed, subdirs = future.result()
+                    listed += was_listed
+                    skipped += not was_listed
+                    pending |= {
+                        executor.submit(self._visit, filesystem, *subdir, full)
+                        for subdir in subdirs
+                    }
+
+        logging.info(
+            f"Catalog refreshed: {listed} directories listed, {skipped} unchanged"
+        )
+        return listed, skipped
+
+    def _visit(self, filesystem, path, parent, mtime, full):
+        """Lists one directory if it changed and returns its subdirectories."""
+        with _connection(filesystem) as conn:
+            if mtime is None:
+                mtime = _mtime(conn.getinfo(path, namespaces=["details"]))
+
+            with self.lock:
+                row = self.con.execute(
+                    "SELECT mtime FROM dirs WHERE path = ?", (path,)
+                ).fetchone()
+            if not full and row is not None and row[0] == mtime:
+                # Unchanged: the files are current, only the subdirectories
+                # have to be checked
+                with self.lock:
+                    subdirs = [
+                        r[0]
+                        for r in self.con.execute(
+                            "SELECT path FROM dirs WHERE parent = ?", (path,)
+                        )
+                    ]
+                return False, [
+                    (sub, path, _mtime(conn.getinfo(sub, namespaces=["details"])))
+                    for sub in subdirs
+                ]
+
+            entries = list(conn.scandir(path, namespaces=["details"]))
+
+        files = [
+            (
+                posixpath.join(path, e.name),
+                path,
+                e.size,
+                _mtime(e),
+                posixpath.splitext(e.name)[1].lower(),
+            )
+            for e in entries
+            if not e.is_dir
+        ]
+        subdirs = [
+            (posixpath.join(path, e.name), path, _mtime(e)) for e in entries if e.is_dir
+        ]
+        names = {sub for sub, *_ in subdirs}
+        with self.lock:
+            self.con.execute("BEGIN")
+            try:
+                self.con.execute("DELETE FROM files WHERE dir = ?", (path,))
+                self.con.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)", files)
+                for (gone,) in self.con.execute(
+                    "SELECT path FROM dirs WHERE parent = ?", (path,)
+                ).fetchall():
+                    if gone not in names:
+                        self._forget(gone)
+                self.con.execute(
+                    "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)",
+                    (path, parent, mtime, time.time()),
+                )
+            except Exception:
+                self.con.execute("ROLLBACK")
+                raise
+            self.con.execute("COMMIT")
+        # A new subdirectory has no stored mtime and is always listed
+        return True, subdirs
+
+    def _forget(self, path):
+        """Removes a vanished directory and everything below it."""
+        below = _below(path)
+        self.con.execute(
+            "DELETE FROM files WHERE dir = ? OR substr(dir, 1, ?) = ?", (path, *below)
+        )
+        self.con.execute(
+            "DELETE FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?", (path, *below)
+        )
+
+    def files(self, root="/", patterns=None):
+        """Yields ``(path, size, mtime)`` of the catalogued files below ``root``.
+
+        Args:
+            root: Directory to list.
+            patterns: Optional file name patterns, e.g. ``AUDIO_PATTERNS``.
+        """
+        root = posixpath.normpath("/" + root.strip("/"))
+        with self.lock:
+            rows = self.con.execute(
+                "SELECT path, size, mtime FROM files"
+                " WHERE dir = ? OR substr(dir, 1, ?) = ? ORDER BY path",
+                (root, *_below(root)),
+            ).fetchall()
+        for path, size, mtime in rows:
+            name = posixpath.basename(path)
+            if patterns is None or any(fnmatch.fnmatchcase(name, p) for p in patterns):
+                yield path, size, mtime
+
+    def find(self, name):
+        """Paths of the catalogued files called ``name``."""
+        with self.lock:
+            return [
+                r[0]
+                for r in self.con.execute(
+                    "SELECT path FROM files WHERE path LIKE ? ESCAPE '\\'",
+                    ("%/" + name.replace("%", "\\%").replace("_", "\\_"),),
+                )
+                # LIKE ignores the case of ASCII letters
+                if posixpath.basename(r[0]) == name
+            ]
+
+    def close(self):
+        self.con.close()
+
+
+def _below(path):
+    """``(length, prefix)`` of the paths below a directory, for ``substr``.
+
+    Unlike ``LIKE``, the comparison is case-sensitive and takes ``_`` and
+    ``%`` literally.
+    """
+    prefix = path.rstrip("/") + "/"
+    return len(prefix), prefix
+
+
+@contextlib.contextmanager
+def _connection(filesystem):
+    if isinstance(filesystem, ConnectionPool):
+        with filesystem.connection() as conn:
+            yield conn
+    else:
+        yield filesystem
+
+
+def _mtime(info):
+    modified = info.modified
+    return modified.timestamp() if modified is not None else 0.0
+
+
+def open_catalog(config):
+    """Catalog of the ``CATALOG_FILE`` of a connection config, None if not set."""
+    if not config.get("CATALOG_FILE"):
+        return None
+    return FileCatalog(config["CATALOG_FILE"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Refresh the catalog of the audio files and print their paths."
+    )
+    parser.add_argument(
+        "--config",
+        default="config_connection.yaml",
+        help="Path to the configuration file.",
+    )
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument(
+        "--full", action="store_true", help="List every directory again."
+    )
+    parser.add_argument(
+        "--no_refresh", action="store_true", help="Only print the catalogued files."
+    )
+    parser.add_argument(
+        "--prefix",
+        default=None,
+        help="Prepended to the printed paths, defaults to the connection string.",
+    )
+    args = parser.parse_args()
+
+    with pathlib.Path(args.config).open() as config_file:
+        config = yaml.safe_load(config_file)
+
+    catalog = open_catalog(config) or FileCatalog("catalog.sqlite")
+    if not args.no_refresh:
+        catalog.refresh(
+            get_pool(config["CONNECTION_STRING"]),
+            config["INPUT_PATH"],
+            workers=args.workers,
+            full=args.full,
+        )
+
+    prefix = config["CONNECTION_STRING"] if args.prefix is None else args.prefix
+    for path, _size, _mtime in catalog.files(config["INPUT_PATH"], AUDIO_PATTERNS):
+        print(prefix.rstrip("/") + path)
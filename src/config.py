@@ -16,11 +16,11 @@ MODEL_VERSION: str = "V2.4"
 PB_MODEL: str = "./checkpoints/V2.4/BirdNET_GLOBAL_6K_V2.4_Model"
 # MODEL_PATH = PB_MODEL # This will load the protobuf model
 MODEL_PATH: str = "./checkpoints/V2.4/BirdNET_GLOBAL_6K_V2.4_Model_FP32.tflite"
-MDATA_MODEL_PATH: str = "./checkpoints/V2.4/BirdNET_GLOBAL_6K_V2.4_MData_Model_V2_FP16.tflite"
-LABELS_FILE: str = "./checkpoints/V2.4/BirdNET_GLOBAL_6K_V2.4_Labels.txt"
-TRANSLATED_LABELS_PATH: str = (
-    "./labels/V2.4"
+MDATA_MODEL_PATH: str = (
+    "./checkpoints/V2.4/BirdNET_GLOBAL_6K_V2.4_MData_Model_V2_FP16.tflite"
 )
+LABELS_FILE: str = "./checkpoints/V2.4/BirdNET_GLOBAL_6K_V2.4_Labels.txt"
+TRANSLATED_LABELS_PATH: str = "./labels/V2.4"
 
 # Path to custom trained classifier
 # If None, no custom classifier will be used
@@ -63,6 +63,16 @@ LONGITUDE: float = -1
 WEEK: int = -1
 LOCATION_FILTER_THRESHOLD: float = 0.03
 
+# Whether to only report the species the metadata model expects at the
+# recording site and week. Coordinates come from SITE_TABLE (CSV with
+# site,latitude,longitude columns) or the path, the week from the date in the
+# file name. SITE_PATTERN is matched against the file path, its named groups
+# 'site', 'lat', 'lon' and 'date' (YYYYMMDD) are used when present.
+# LATITUDE, LONGITUDE and WEEK above are the fallback values.
+LOCATION_FILTER: bool = False
+SITE_TABLE: str | None = None
+SITE_PATTERN: str = r"(?P<site>[^/]+)/[^/]*?(?P<date>\d{8})_\d{6}[^/]*$"
+
 ######################
 # Inference settings #
 ######################
@@ -70,16 +80,14 @@ LOCATION_FILTER_THRESHOLD: float = 0.03
 # If None or empty file, no custom species list will be used
 # Note: Entries in this list have to match entries from the LABELS_FILE
 # We use the 2021 eBird taxonomy for species names (Clements list)
-CODES_FILE: str = (
-    "./eBird_taxonomy_codes_2021E.json"
-)
-SPECIES_LIST_FILE: str = (
-    "./example/species_list.txt"
-)
+CODES_FILE: str = "./eBird_taxonomy_codes_2021E.json"
+SPECIES_LIST_FILE: str = "./example/species_list.txt"
 
 # File input path and output path for selection tables
 INPUT_PATH: str = "example/"
-OUTPUT_PATH: str = "/data/Prosjekter3/824001_05_metodesats_gis_24_41_flittie_kleiven/birdnetResults"
+OUTPUT_PATH: str = (
+    "/data/Prosjekter3/824001_05_metodesats_gis_24_41_flittie_kleiven/birdnetResults"
+)
 
 # Supported file types
 ALLOWED_FILETYPES: list[str] = [
@@ -98,6 +106,9 @@ ALLOWED_FILETYPES: list[str] = [
 CPU_THREADS: int = 8
 TFLITE_THREADS: int = 1
 
+# Whether to bind every analysis worker to its own set of TFLITE_THREADS CPUs
+PIN_WORKERS: bool = False
+
 # False will output logits, True will convert to sigmoid activations
 APPLY_SIGMOID: bool = True
 SIGMOID_SENSITIVITY: float = 1.0
@@ -107,17 +118,66 @@ SIGMOID_SENSITIVITY: float = 1.0
 # probabilities and needs to be adjusted)
 MIN_CONFIDENCE: float = 0.1
 
+# Maximum number of labels reported per chunk, 0 reports every label
+# above MIN_CONFIDENCE
+TOP_K: int = 0
+
 # Number of samples to process at the same time. Higher values can increase
 # processing speed, but will also increase memory usage.
 # Might only be useful for GPU inference.
 BATCH_SIZE: int = 1
 
+# Whether to fill batches with chunks from several files. Useful for short
+# recordings that never fill a batch on their own (ignored with STREAM_AUDIO)
+BATCH_ACROSS_FILES: bool = False
+
+# Seconds after which an incomplete batch is predicted anyway when batching
+# across files, which bounds the delay before a file's results are written
+BATCH_TIMEOUT: float = 5.0
+
 
 # Number of seconds to load from a file at a time
 # Files will be loaded into memory in segments that are only as long as this value
 # Lowering this value results in lower memory usage
 FILE_SPLITTING_DURATION: int = 600
 
+# Whether to decode, resample and analyse files one FILE_SPLITTING_DURATION
+# window at a time. Keeps memory usage bounded for very long recordings.
+# Formats libsndfile cannot read (e.g. MP3) need ffmpeg to be streamed, they
+# are decoded whole otherwise.
+STREAM_AUDIO: bool = False
+
+# Number of files fetched and decoded in the background while the current
+# file is analysed, 0 disables prefetching
+PREFETCH_DEPTH: int = 0
+
+# Maximum memory (MB) used by decoded files waiting in the prefetch queue
+PREFETCH_MAX_MB: int = 2048
+
+# Local directory keeping a copy of the remote (e.g. ssh://) recordings, so
+# that the analysis workers and extract.py download each of them only once.
+# None reads remote files directly
+AUDIO_CACHE_DIR: str | None = None
+
+# Size cap of the audio cache, the least recently used recordings are
+# evicted first. Recordings pinned with `python src/audio_cache.py pin` are kept
+AUDIO_CACHE_MAX_GB: float = 50.0
+
+# SSH/SFTP connections are opened once per process and reused. At most
+# SSH_MAX_CONNECTIONS_PER_HOST are used at once by each process (worker
+# processes do not share the limit), connections idle for longer
+# than SSH_HEALTH_CHECK_INTERVAL seconds are checked before reuse, and a
+# failed connection is retried SSH_CONNECT_ATTEMPTS times with backoff
+SSH_MAX_CONNECTIONS_PER_HOST: int = 4
+SSH_HEALTH_CHECK_INTERVAL: float = 60.0
+SSH_CONNECT_ATTEMPTS: int = 8
+
+# Pre-inference silence gate: chunks quieter than SILENCE_THRESHOLD_DB (dB full
+# scale) are not sent to the model. 'rms' uses the broadband level, 'band'
+# the level between BANDPASS_FMIN and BANDPASS_FMAX, None disables the gate
+SILENCE_GATE: str | None = None
+SILENCE_THRESHOLD_DB: float = -60.0
+
 # Whether to use noise to pad the signal
 # If set to False, the signal will be padded with zeros
 USE_NOISE: bool = False
@@ -130,10 +190,30 @@ OUTPUT_FILENAME: str = (
     "BirdNET_SelectionTable.txt"  # this is for combined Raven selection tables only
 )
 
+# Whether to also save the full chunk x label score matrix of every file next
+# to its selection table, so that results can be re-exported with other
+# thresholds or species lists without running the model again (see reexport.py)
+SAVE_SCORES: bool = False
+
+# Storage type of the saved scores, 'float16' or 'uint8' (quantized)
+SCORES_DTYPE: str = "float16"
+
+# Scores below this value are saved as 0, which greatly reduces file size
+SCORES_FLOOR: float = 0.01
+
 # Whether to skip existing results in the output path
 # If set to False, existing files will not be overwritten
 SKIP_EXISTING_RESULTS: bool = False
 
+# SQLite database recording the size, modification time and analysis
+# parameters of every analysed file. With SKIP_EXISTING_RESULTS, files whose
+# entry is still current are not analysed again
+MANIFEST_FILE: str = "analysis_manifest.sqlite"
+
+# JSON-lines file receiving the per-stage timings and counters of every
+# analysed file and a summary at the end of each run, None to disable
+METRICS_FILE: str | None = "analysis_metrics.jsonl"
+
 #####################
 # Training settings #
 #####################
@@ -211,6 +291,8 @@ CODES = {}
 LABELS: list[str] = []
 TRANSLATED_LABELS: list[str] = []
 SPECIES_LIST: list[str] = []
+# Lookup tables built from LABELS, CODES and SPECIES_LIST at startup
+LABEL_REGISTRY = None
 ERROR_LOG_FILE: str = "error_log.txt"
 FILE_LIST = []
 FILE_STORAGE_PATH: str = ""
@@ -281,6 +363,29 @@ def getConfig():
         "FILE_STORAGE_PATH": FILE_STORAGE_PATH,
         "SKIP_EXISTING_RESULTS": SKIP_EXISTING_RESULTS,
         "USE_NOISE": USE_NOISE,
+        "STREAM_AUDIO": STREAM_AUDIO,
+        "FILE_SPLITTING_DURATION": FILE_SPLITTING_DURATION,
+        "TOP_K": TOP_K,
+        "SAVE_SCORES": SAVE_SCORES,
+        "SCORES_DTYPE": SCORES_DTYPE,
+        "SCORES_FLOOR": SCORES_FLOOR,
+        "PREFETCH_DEPTH": PREFETCH_DEPTH,
+        "PREFETCH_MAX_MB": PREFETCH_MAX_MB,
+        "AUDIO_CACHE_DIR": AUDIO_CACHE_DIR,
+        "AUDIO_CACHE_MAX_GB": AUDIO_CACHE_MAX_GB,
+        "SSH_MAX_CONNECTIONS_PER_HOST": SSH_MAX_CONNECTIONS_PER_HOST,
+        "SSH_HEALTH_CHECK_INTERVAL": SSH_HEALTH_CHECK_INTERVAL,
+        "SSH_CONNECT_ATTEMPTS": SSH_CONNECT_ATTEMPTS,
+        "MANIFEST_FILE": MANIFEST_FILE,
+        "METRICS_FILE": METRICS_FILE,
+        "BATCH_ACROSS_FILES": BATCH_ACROSS_FILES,
+        "BATCH_TIMEOUT": BATCH_TIMEOUT,
+        "PIN_WORKERS": PIN_WORKERS,
+        "SILENCE_GATE": SILENCE_GATE,
+        "SILENCE_THRESHOLD_DB": SILENCE_THRESHOLD_DB,
+        "LOCATION_FILTER": LOCATION_FILTER,
+        "SITE_TABLE": SITE_TABLE,
+        "SITE_PATTERN": SITE_PATTERN,
     }
 
 
@@ -344,6 +449,29 @@ def setConfig(c):
     global FILE_STORAGE_PATH
     global SKIP_EXISTING_RESULTS
     global USE_NOISE
+    global STREAM_AUDIO
+    global FILE_SPLITTING_DURATION
+    global TOP_K
+    global SAVE_SCORES
+    global SCORES_DTYPE
+    global SCORES_FLOOR
+    global PREFETCH_DEPTH
+    global PREFETCH_MAX_MB
+    global AUDIO_CACHE_DIR
+    global AUDIO_CACHE_MAX_GB
+    global SSH_MAX_CONNECTIONS_PER_HOST
+    global SSH_HEALTH_CHECK_INTERVAL
+    global SSH_CONNECT_ATTEMPTS
+    global MANIFEST_FILE
+    global METRICS_FILE
+    global BATCH_ACROSS_FILES
+    global BATCH_TIMEOUT
+    global PIN_WORKERS
+    global SILENCE_GATE
+    global SILENCE_THRESHOLD_DB
+    global LOCATION_FILTER
+    global SITE_TABLE
+    global SITE_PATTERN
 
     RANDOM_SEED = c["RANDOM_SEED"]
     MODEL_VERSION = c["MODEL_VERSION"]
@@ -404,3 +532,26 @@ def setConfig(c):
     FILE_STORAGE_PATH = c["FILE_STORAGE_PATH"]
     SKIP_EXISTING_RESULTS = c["SKIP_EXISTING_RESULTS"]
     USE_NOISE = c["USE_NOISE"]
+    STREAM_AUDIO = c["STREAM_AUDIO"]
+    FILE_SPLITTING_DURATION = c["FILE_SPLITTING_DURATION"]
+    TOP_K = c["TOP_K"]
+    SAVE_SCORES = c["SAVE_SCORES"]
+    SCORES_DTYPE = c["SCORES_DTYPE"]
+    SCORES_FLOOR = c["SCORES_FLOOR"]
+    PREFETCH_DEPTH = c["PREFETCH_DEPTH"]
+    PREFETCH_MAX_MB = c["PREFETCH_MAX_MB"]
+    AUDIO_CACHE_DIR = c["AUDIO_CACHE_DIR"]
+    AUDIO_CACHE_MAX_GB = c["AUDIO_CACHE_MAX_GB"]
+    SSH_MAX_CONNECTIONS_PER_HOST = c["SSH_MAX_CONNECTIONS_PER_HOST"]
+    SSH_HEALTH_CHECK_INTERVAL = c["SSH_HEALTH_CHECK_INTERVAL"]
+    SSH_CONNECT_ATTEMPTS = c["SSH_CONNECT_ATTEMPTS"]
+    MANIFEST_FILE = c["MANIFEST_FILE"]
+    METRICS_FILE = c["METRICS_FILE"]
+    BATCH_ACROSS_FILES = c["BATCH_ACROSS_FILES"]
+    BATCH_TIMEOUT = c["BATCH_TIMEOUT"]
+    PIN_WORKERS = c["PIN_WORKERS"]
+    SILENCE_GATE = c["SILENCE_GATE"]
+    SILENCE_THRESHOLD_DB = c["SILENCE_THRESHOLD_DB"]
+    LOCATION_FILTER = c["LOCATION_FILTER"]
+    SITE_TABLE = c["SITE_TABLE"]
+    SITE_PATTERN = c["SITE_PATTERN"]
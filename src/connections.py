@@ -0,0 +1,195 @@
+import contextlib
+import logging
+import queue
+import threading
+import time
+import urllib.parse
+
+import config as cfg
+import fs
+import fsspec
+from tenacity import Retrying, stop_after_attempt, wait_exponential
+
+POOLED_PROTOCOLS = ("ssh", "sftp")
+
+
+class ConnectionPool:
+    """Bounded pool of long-lived connections to one filesystem.
+
+    Connections (``fs.open_fs`` filesystems, e.g. SFTP sessions) are opened
+    on first use and then reused by the threads of the process, so a worker
+    analysing or extracting many files performs a single SSH handshake.
+    Connections idle for longer than ``cfg.SSH_HEALTH_CHECK_INTERVAL`` are
+    checked before reuse and reopened, with exponential backoff, if broken.
+    At most ``cfg.SSH_MAX_CONNECTIONS_PER_HOST`` connections to the same host
+    are in use at once in this process, callers wait for a free one. The
+    limit is per process: N worker processes can open N times as many.
+
+    Besides ``connection()``, the pool can be used in place of a single
+    filesystem: ``openbin`` and ``walk`` keep their connection until the
+    file is closed or the walk is done, other methods run on a pooled
+    connection.
+
+    Args:
+        connection_string: ``fs.open_fs`` URL, e.g. ``ssh://user:pw@host``.
+    """
+
+    def __init__(self, connection_string):
+        self.connection_string = connection_string
+        self._idle = queue.LifoQueue()
+        self._slots = _host_slots(urllib.parse.urlsplit(connection_string).hostname)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Checks out a connection for the duration of the block."""
+        with self._slots:
+            filesystem = self._checkout()
+            try:
+                yield filesystem
+            except Exception:
+                # Do not hand out a connection that broke during the call
+                if not _healthy(filesystem):
+                    _close(filesystem)
+                    raise
+                self._idle.put((filesystem, time.monotonic()))
+                raise
+            self._idle.put((filesystem, time.monotonic()))
+
+    def _checkout(self):
+        while True:
+            try:
+                filesystem, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            idle = time.monotonic() - last_used
+            if idle < cfg.SSH_HEALTH_CHECK_INTERVAL or _healthy(filesystem):
+                return filesystem
+            logging.info(f"Reconnecting to {_redact(self.connection_string)}")
+            _close(filesystem)
+
+    def _connect(self):
+        for attempt in Retrying(
+            wait=wait_exponential(multiplier=1, min=4, max=120),
+            stop=stop_after_attempt(cfg.SSH_CONNECT_ATTEMPTS),
+            reraise=True,
+        ):
+            with attempt:
+                try:
+                    return fs.open_fs(self.connection_string)
+                except Exception as e:
+                    logging.error(f"Attempt failed to connect to filesystem: {e}")
+                    raise
+
+    def openbin(self, path, mode="r"):
+        """Opens a file, the connection is returned to the pool on close."""
+        with contextlib.ExitStack() as stack:
+            filesystem = stack.enter_context(self.connection())
+            f = filesystem.openbin(path, mode)
+            # The connection is released by the file from now on
+            return _PooledFile(f, stack.pop_all())
+
+    def walk(self, *args, **kwargs):
+        """Like ``filesystem.walk``, on one connection for the whole walk."""
+        with self.connection() as filesystem:
+            yield from filesystem.walk(*args, **kwargs)
+
+    def close(self):
+        while True:
+            try:
+                filesystem, _last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            _close(filesystem)
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            with self.connection() as filesystem:
+                return getattr(filesystem, name)(*args, **kwargs)
+
+        return call
+
+
+class _PooledFile:
+    """File object that returns its connection to the pool when closed."""
+
+    def __init__(self, f, stack):
+        self._f = f
+        self._stack = stack
+
+    def close(self):
+        try:
+            self._f.close()
+        finally:
+            self._stack.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+def _healthy(filesystem):
+    try:
+        filesystem.getinfo("/")
+        return True
+    except Exception:
+        return False
+
+
+def _close(filesystem):
+    with contextlib.suppress(Exception):
+        filesystem.close()
+
+
+def _redact(connection_string):
+    parts = urllib.parse.urlsplit(connection_string)
+    return f"{parts.scheme}://{parts.hostname}"
+
+
+_lock = threading.RLock()
+_pools = {}
+_slots = {}
+
+
+def _host_slots(host):
+    with _lock:
+        if host not in _slots:
+            _slots[host] = threading.BoundedSemaphore(
+                max(1, cfg.SSH_MAX_CONNECTIONS_PER_HOST)
+            )
+        return _slots[host]
+
+
+def get_pool(connection_string):
+    """The connection pool of ``connection_string`` in this process."""
+    with _lock:
+        if connection_string not in _pools:
+            _pools[connection_string] = ConnectionPool(connection_string)
+        return _pools[connection_string]
+
+
+def split_pooled_url(url):
+    """(connection string, path) of an SSH URL, None for other URLs.
+
+    ``ssh://user:pw@host:/data/a.wav`` gives ``("ssh://user:pw@host",
+    "/data/a.wav")``. Chained fsspec URLs (``filecache::ssh://...``) are
+    left to fsspec.
+    """
+    url = str(url)
+    parts = urllib.parse.urlsplit(url)
+    if "::" in url or parts.scheme not in POOLED_PROTOCOLS:
+        return None
+    return f"{parts.scheme}://{parts.netloc.rstrip(':')}", parts.path
+
+
+def open_remote(url):
+    """Opens a local or remote file, SSH files through the connection pool."""
+    pooled = split_pooled_url(url)
+    if pooled is None:
+        return fsspec.open(url).open()
+    connection_string, path = pooled
+    return get_pool(connection_string).openbin(path)
@@ -0,0 +1,159 @@
+import pathlib
+import shutil
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+# Columns of the detections read from the selection tables
+SEGMENT_SCHEMA = pa.schema(
+    [
+        ("audio", pa.string()),
+        ("start", pa.float64()),
+        ("end", pa.float64()),
+        ("species", pa.string()),
+        ("confidence", pa.float64()),
+    ]
+)
+
+# Columns of the detection dataset, the site and date are parsed from the
+# audio path
+DETECTION_SCHEMA = SEGMENT_SCHEMA.append(pa.field("site", pa.string())).append(
+    pa.field("date", pa.string())
+)
+
+# Parquet layout of the dataset. Rows are buffered per partition until a row
+# group is full, so memory is bounded by MAX_OPEN_FILES row groups.
+MIN_ROWS_PER_GROUP = 64 * 1024
+MAX_ROWS_PER_GROUP = 512 * 1024
+MAX_ROWS_PER_FILE = 8 * 1024 * 1024
+MAX_OPEN_FILES = 512
+
+
+def add_site_columns(table, site_pattern):
+    """Adds the ``site`` and ``date`` of the recordings to a segments table.
+
+    Args:
+        table: Table with the ``SEGMENT_SCHEMA`` columns.
+        site_pattern: Regular expression with ``site`` and/or ``date`` named
+            groups matched against the audio path, see ``cfg.SITE_PATTERN``.
+            The columns are null when the path does not match.
+    """
+    groups = pc.extract_regex(table["audio"], site_pattern) if site_pattern else None
+    for name in ("site", "date"):
+        if groups is not None and name in [f.name for f in groups.type]:
+            values = pc.if_else(
+                pc.is_valid(groups),
+                pc.struct_field(groups, name),
+                pa.scalar(None, pa.string()),
+            )
+        else:
+            values = pa.nulls(table.num_rows, pa.string())
+        table = table.append_column(name, values)
+    return table
+
+
+def conform_detections(table, schema=DETECTION_SCHEMA):
+    """A table of detections with the columns of ``schema``, in its order.
+
+    Missing columns, e.g. the site of a database written before it was
+    recorded, are null.
+    """
+    for field in schema:
+        if field.name not in table.column_names:
+            table = table.append_column(field, pa.nulls(table.num_rows, field.type))
+    return table.select(schema.names).cast(schema)
+
+
+def write_detections(
+    tables,
+    path,
+    partition_by=("species",),
+    schema=DETECTION_SCHEMA,
+    basename_template="part-{i}.parquet",
+):
+    """Streams tables of detections into a partitioned Parquet dataset.
+
+    The tables are written as they come, so only the row groups being
+    filled are kept in memory. The dataset replaces any previous one at
+    ``path``.
+
+    Args:
+        tables: Iterable of tables with the ``schema`` columns.
+        path: Folder of the dataset.
+        partition_by: Columns of the hive partitioning, e.g. ``("species",)``
+            or ``("site", "date")``. Empty for a plain dataset.
+        schema: Schema of the tables.
+        basename_template: Names of the data files, ``{i}`` is replaced by
+            a counter.
+
+    Returns:
+        The number of rows written.
+    """
+    rows = 0
+
+    def batches():
+        nonlocal rows
+        for table in tables:
+            rows += table.num_rows
+            yield from conform_detections(table, schema).to_batches()
+
+    if pathlib.Path(path).is_dir():
+        shutil.rmtree(path)
+    else:
+        pathlib.Path(path).unlink(missing_ok=True)
+
+    ds.write_dataset(
+        pa.RecordBatchReader.from_batches(schema, batches()),
+        path,
+        format="parquet",
+        partitioning=partitioning(partition_by, schema),
+        basename_template=basename_template,
+        min_rows_per_group=MIN_ROWS_PER_GROUP,
+        max_rows_per_group=MAX_ROWS_PER_GROUP,
+        max_rows_per_file=MAX_ROWS_PER_FILE,
+        max_open_files=MAX_OPEN_FILES,
+        file_options=ds.ParquetFileFormat().make_write_options(compression="zstd"),
+    )
+    return rows
+
+
+def partitioning(partition_by, schema=DETECTION_SCHEMA):
+    """Hive partitioning of the dataset on the ``partition_by`` columns."""
+    if not partition_by:
+        return None
+    return ds.partitioning(
+        pa.schema([schema.field(name) for name in partition_by]), flavor="hive"
+    )
+
+
+def detection_dataset(path, schema=DETECTION_SCHEMA):
+    """The detections at ``path``, a partitioned dataset or a single file.
+
+    Partition values keep the types of ``schema`` (a ``date`` stays a
+    string), so filters on them prune whole folders.
+    """
+    dataset = ds.dataset(path, format="parquet", partitioning="hive")
+    if dataset.partitioning is None:
+        return dataset
+    names = dataset.partitioning.schema.names
+    return ds.dataset(
+        path,
+        format="parquet",
+        partitioning=partitioning(names, schema),
+    )
+
+
+def read_detections(path, columns=None, predicate=None):
+    """Reads detections into a DataFrame.
+
+    Args:
+        path: Dataset folder or Parquet file.
+        columns: Columns to read, all by default.
+        predicate: ``pyarrow.dataset`` expression, pushed down to the Parquet
+            row group statistics and the partitions, e.g.
+            ``ds.field("start") < 3600``.
+    """
+    return (
+        detection_dataset(path).to_table(columns=columns, filter=predicate).to_pandas()
+    )
@@ -1,14 +1,35 @@
 import argparse
+import concurrent.futures
+import functools
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
-import pandas as pd
+import pathlib
+import posixpath
+import sqlite3
+import threading
+import time
 
-import fs
-import pyarrow.parquet as pq
+import config as cfg
+import librosa
+import numpy as np
+import pandas as pd
 import yaml
-from tenacity import retry, wait_exponential
-
+from audio_cache import get_audio_cache
+from catalog import open_catalog
+from connections import get_pool
 from utils import openAudioFile, openCachedFile, saveSignal
+from wav_range import read_wav_frames, read_wav_header
+
+# Record of the recordings already extracted, to resume an interrupted run
+PROGRESS_FILE = "extract_progress.sqlite"
+
+# Default number of extraction processes. Every process opens its own SSH
+# connections, so this also bounds the connections to the audio host.
+WORKERS = 4
+
 
 def setup_logging():
     logging.basicConfig(
@@ -18,46 +39,352 @@ def setup_logging():
         datefmt="%Y-%m-%d %H:%M:%S",
     )
 
-@retry(wait=wait_exponential(multiplier=1, min=4, max=120))
+
 def do_connection(connection_string):
-    """Establish a connection to the filesystem with retries."""
-    try:
-        if connection_string:
-            return fs.open_fs(connection_string)
-        return False
-    except Exception:
-        # logging.error(f"Attempt failed to connect to filesystem: {e}")
-        # logging.info("Retrying connection...")
-        raise
+    """Pooled connections to the filesystem, opened with retries on first use."""
+    if connection_string:
+        return get_pool(connection_string)
+    return False
+
+
+def remote_url(connection_string, path):
+    """URL of a file of the connection, the audio cache key of the recording."""
+    return f"{connection_string.rstrip('/')}/{path.lstrip('/')}"
+
+
+class ExtractProgress:
+    """SQLite record of the recordings whose segments were extracted.
+
+    A recording is done when its segments and the extraction settings match
+    the ones of the last successful extraction, so a new sample extracts
+    the recordings whose segments changed.
+
+    Args:
+        path: Path of the SQLite database, created if needed.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute(
+            """CREATE TABLE IF NOT EXISTS recordings (
+                audio TEXT PRIMARY KEY,
+                segments TEXT,
+                saved INTEGER,
+                finished REAL
+            )"""
+        )
+
+    def is_done(self, audio, key):
+        with self.lock:
+            row = self.con.execute(
+                "SELECT segments FROM recordings WHERE audio = ?", (audio,)
+            ).fetchone()
+        return row is not None and row[0] == key
+
+    def record(self, audio, key, saved):
+        with self.lock:
+            self.con.execute(
+                "INSERT OR REPLACE INTO recordings VALUES (?, ?, ?, ?)",
+                (audio, key, saved, time.time()),
+            )
+
+    def clear(self):
+        with self.lock:
+            self.con.execute("DELETE FROM recordings")
+
+    def close(self):
+        self.con.close()
+
+
+def segments_key(segments, sample_rate, out_path, seg_length):
+    """Hash of the segments of a recording and of the extraction settings."""
+    rows = sorted(
+        (s["species"], float(s["start"]), float(s["end"]), float(s["confidence"]))
+        for s in segments
+    )
+    return hashlib.sha1(  # noqa: S324
+        json.dumps([sample_rate, out_path, seg_length, rows]).encode()
+    ).hexdigest()
+
+
+def group_by_recording(sampled_df):
+    """``[(audio, segments)]`` of the sampled detections, grouped by exact path."""
+    return [
+        (audio, group.to_dict("records"))
+        for audio, group in sampled_df.groupby("audio", sort=False)
+    ]
+
+
+def select_recordings(sampled_df, audio_files, catalog=None):
+    """The detections of the given recordings.
+
+    Paths are matched exactly. A bare file name matches the recordings of
+    that name, restricted to the catalogued paths when a catalog is given.
+    """
+    paths = sampled_df["audio"].str.lstrip("/")
+    wanted = {f.lstrip("/") for f in audio_files if "/" in f}
+    names = {f for f in audio_files if "/" not in f}
+    if catalog is not None:
+        for name in names:
+            wanted.update(path.lstrip("/") for path in catalog.find(name))
+        names = set()
+    return sampled_df[paths.isin(wanted) | paths.map(os.path.basename).isin(names)]
+
+
+def extract_all(
+    sampled_df,
+    sample_rate,
+    out_path,
+    connection_string,
+    seg_length=3,
+    workers=None,
+    progress=None,
+):
+    """Extracts the segments of all the sampled detections.
+
+    The detections are grouped by recording and every recording is fetched
+    and decoded once for all its segments, by ``extract_recording``. The
+    recordings are spread over a pool of ``workers`` processes (``WORKERS``
+    by default, in this process if 1), each with its own connection pool
+    and so its own SSH connection.
+    With a ``progress`` record, the recordings already extracted with the
+    same segments are skipped and every finished recording is recorded, so
+    an interrupted run resumes where it stopped.
+
+    Returns:
+        The number of recordings and of segments extracted, and the number
+        of recordings that failed.
+    """
+    recordings = []
+    for audio, segments in group_by_recording(sampled_df):
+        key = segments_key(segments, sample_rate, out_path, seg_length)
+        if progress is None or not progress.is_done(audio, key):
+            recordings.append((audio, segments, key))
+    print(f"{len(recordings)} recordings to extract")
+
+    done = saved = failed = 0
+
+    def finish(audio, key, n_segments, result):
+        nonlocal done, saved, failed
+        try:
+            count = result()
+            if n_segments and not count:
+                raise ValueError("no segment could be read")
+        except Exception as e:
+            # Not recorded, so that the next run retries the recording
+            logging.error(f"Error extracting the segments of {audio}: {e}")
+            failed += 1
+            return
+        if progress is not None:
+            progress.record(audio, key, count)
+        done += 1
+        saved += count
+        print(f"{done}/{len(recordings)} {audio}: {count} segments saved")
+
+    workers = workers or WORKERS
+    task_args = (sample_rate, out_path, connection_string, seg_length)
+    if workers <= 1 or len(recordings) <= 1:
+        for audio, segments, key in recordings:
+            task = functools.partial(extract_task, audio, segments, *task_args)
+            finish(audio, key, len(segments), task)
+        return done, saved, failed
+
+    with concurrent.futures.ProcessPoolExecutor(
+        min(workers, len(recordings)),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(cfg.AUDIO_CACHE_DIR, cfg.AUDIO_CACHE_MAX_GB),
+    ) as executor:
+        # At most two recordings per worker are in flight
+        pending = {}
+        for audio, segments, key in recordings:
+            future = executor.submit(extract_task, audio, segments, *task_args)
+            pending[future] = (audio, key, len(segments))
+            while len(pending) >= 2 * workers:
+                finished, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    finish(*pending.pop(future), future.result)
+        for future in concurrent.futures.as_completed(pending):
+            finish(*pending[future], future.result)
+    return done, saved, failed
+
+
+def init_worker(audio_cache_dir, audio_cache_max_gb):
+    """Configures the audio cache of a spawned worker as in the parent."""
+    cfg.AUDIO_CACHE_DIR = audio_cache_dir
+    cfg.AUDIO_CACHE_MAX_GB = audio_cache_max_gb
+
+
+def extract_task(audio, segments, sample_rate, out_path, connection_string, seg_length):
+    """Extracts the segments of a recording in a worker, then unpins it."""
+    count = extract_recording(
+        audio,
+        segments,
+        sample_rate,
+        out_path,
+        do_connection(connection_string),
+        connection_string,
+        seg_length,
+    )
+    # The recording is not needed in the audio cache anymore
+    cache = get_audio_cache()
+    if cache is not None:
+        cache.unpin(remote_url(connection_string, audio))
+    return count
+
 
 # @retry(wait=wait_exponential(multiplier=5, min=60, max=600))
 def extract_segments(
     item, sample_rate, out_path, filesystem, connection_string, seg_length=3
 ):
     """Extract segments from the audio file and save them."""
-    segments = item
-    audio_file = os.path.join(connection_string, item["audio"])
+    extract_recording(
+        item["audio"],
+        [item],
+        sample_rate,
+        out_path,
+        filesystem,
+        connection_string,
+        seg_length,
+    )
+
+
+def extract_recording(
+    audio, segments, sample_rate, out_path, filesystem, connection_string, seg_length=3
+):
+    """Extracts all the segments of a recording, read and decoded once.
+
+    Returns:
+        The number of segments saved.
+
+    Raises:
+        ValueError: If the recording could not be decoded.
+    """
+    audio_file = posixpath.join(connection_string, audio)
+    url = remote_url(connection_string, audio)
+
+    # Uncompressed recordings that are not cached yet are read by byte range
+    cache = get_audio_cache()
+    if (
+        filesystem
+        and audio_file.lower().endswith(".wav")
+        and not (cache is not None and cache.contains(url))
+    ):
+        signals = read_segment_ranges(
+            filesystem, audio_file, segments, sample_rate, seg_length
+        )
+        if signals is not None:
+            saved = 0
+            for segment, signal in zip(segments, signals, strict=True):
+                if len(signal):
+                    save_segment(signal, segment, out_path)
+                    saved += 1
+            return saved
 
     signal, rate = (
         openAudioFile(audio_file, sample_rate)
         if not filesystem
-        else openCachedFile(filesystem, audio_file, sample_rate)
+        else openCachedFile(
+            filesystem,
+            audio_file,
+            sample_rate,
+            url=url,
+        )
     )
+    # openAudioFile returns an empty signal when the file cannot be decoded
+    if not len(signal):
+        raise ValueError(f"Could not decode {audio_file}")
 
-    save_extracted_segments(signal, rate, segments, out_path, seg_length)
-    # logging.info(f"Segments extracted from {audio_file}")
+    return sum(
+        save_extracted_segments(signal, rate, segment, out_path, seg_length)
+        for segment in segments
+    )
 
-def save_extracted_segments(signal, rate, segment, out_path, seg_length):
-    """Save the extracted segments to the output path."""
-    # for segment in segments:
+
+def read_segment_range(filesystem, audio_file, segment, sample_rate, seg_length):
+    """Reads the window of a segment from a WAV file without downloading it.
+
+    Only the WAV header and the bytes of the window are transferred.
+
+    Returns:
+        The window resampled to ``sample_rate``, None if the file is not an
+        uncompressed WAV.
+    """
+    signals = read_segment_ranges(
+        filesystem, audio_file, [segment], sample_rate, seg_length
+    )
+    return None if signals is None else signals[0]
+
+
+def read_segment_ranges(filesystem, audio_file, segments, sample_rate, seg_length):
+    """Reads the windows of several segments from a WAV file, header read once.
+
+    Returns:
+        The windows resampled to ``sample_rate``, in the order of
+        ``segments``, None if the file is not an uncompressed WAV.
+    """
+    with filesystem.openbin(audio_file) as f:
+        layout = read_wav_header(f)
+        if layout is None:
+            return None
+        return [
+            read_window(f, layout, segment, sample_rate, seg_length)
+            for segment in segments
+        ]
+
+
+def read_window(f, layout, segment, sample_rate, seg_length):
+    """The window of a segment from an open WAV file, resampled to ``sample_rate``."""
+    if layout.sample_rate == sample_rate:
+        start, end = segment_window(segment, sample_rate, seg_length, layout.frames)
+        return read_wav_frames(f, layout, start, end - start)
+
+    ratio = layout.sample_rate / sample_rate
+    start, end = segment_window(
+        segment, sample_rate, seg_length, int(np.ceil(layout.frames / ratio))
+    )
+    # Read a margin around the window to cut off the resampling edge effects
+    margin = layout.sample_rate // 10
+    src_start = max(0, int(start * ratio) - margin)
+    src_end = int(np.ceil(end * ratio)) + margin
+    signal = read_wav_frames(f, layout, src_start, src_end - src_start)
+
+    if not len(signal):
+        return signal
+    signal = librosa.resample(
+        signal,
+        orig_sr=layout.sample_rate,
+        target_sr=sample_rate,
+        res_type="kaiser_fast",
+    )
+    first = round(src_start / ratio)
+    return signal[start - first : end - first]
+
+
+def segment_window(segment, rate, seg_length, n_samples):
+    """Sample range of a segment, padded to ``seg_length`` s around the detection."""
     start = int(segment["start"] * rate)
     end = int(segment["end"] * rate)
     offset = ((seg_length * rate) - (end - start)) // 2
-    start, end = max(0, start - offset), min(len(signal), end + offset)
+    return max(0, start - offset), min(n_samples, end + offset)
+
+
+def save_extracted_segments(signal, rate, segment, out_path, seg_length):
+    """Save the extracted segments to the output path, True if saved."""
+    start, end = segment_window(segment, rate, seg_length, len(signal))
 
     if end > start:
         segment_signal = signal[start:end]
         save_segment(segment_signal, segment, out_path)
+        return True
+    return False
+
 
 def save_segment(segment_signal, segment, out_path):
     """Save an individual segment."""
@@ -69,6 +396,7 @@ def save_segment(segment_signal, segment, out_path):
     print(f"Segment {segment_path} saved")
     saveSignal(segment_signal, segment_path)
 
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -76,46 +404,71 @@ if __name__ == "__main__":
         default="config_connection.yaml",
         help="Path to the configuration file.",
     )
-    parser.add_argument("--parquet_file", default="sampled_segments.parquet", help="Path to the pre-sampled parquet file.")
-    parser.add_argument("audio_file", help="The audio file to process.")
+    parser.add_argument(
+        "--parquet_file",
+        default="sampled_segments.parquet",
+        help="Path to the pre-sampled parquet file.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help=f"Processes extracting the recordings, {WORKERS} by default. Each"
+        " opens its own SSH connection.",
+    )
+    parser.add_argument(
+        "--progress",
+        default=PROGRESS_FILE,
+        help="SQLite record of the extracted recordings, to resume a run.",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Extract every recording again, also the ones already extracted.",
+    )
+    parser.add_argument(
+        "audio_files",
+        nargs="*",
+        help="Only extract these recordings (paths or file names), all by default.",
+    )
     args = parser.parse_args()
 
-    with open(args.config) as config_file:
-        config = yaml.load(config_file, Loader=yaml.FullLoader)
+    setup_logging()
+    with pathlib.Path(args.config).open() as config_file:
+        config = yaml.safe_load(config_file)
 
-    myfs = do_connection(config["CONNECTION_STRING"])
+    cfg.AUDIO_CACHE_DIR = config.get("AUDIO_CACHE_DIR", cfg.AUDIO_CACHE_DIR)
+    cfg.AUDIO_CACHE_MAX_GB = config.get("AUDIO_CACHE_MAX_GB", cfg.AUDIO_CACHE_MAX_GB)
 
-    # Read the pre-sampled Parquet file into a DataFrame
+    # Read the pre-sampled Parquet file once
     sampled_df = pd.read_parquet(args.parquet_file)
+    if args.audio_files:
+        sampled_df = select_recordings(
+            sampled_df, args.audio_files, open_catalog(config)
+        )
+    print(f"Number of detections to extract: {len(sampled_df)}")
 
-    # Normalize paths and filter by file name
-    audio_file_basename = os.path.basename(args.audio_file)
-    filtered_items = sampled_df[sampled_df['audio'].str.contains(audio_file_basename, na=False, case=False)]
-
-    # Skip processing if no relevant detections are found for the file
-    if filtered_items.empty:
-        print(f"No detections found for {args.audio_file}. Skipping...")
-        exit(0)
-
-    # Log the number of detections
-    print(f"Number of detections for {args.audio_file}: {len(filtered_items)}")
-
-    # Process each detection
-    saved_count = 0
-    for _, item in filtered_items.iterrows():
-        try:
-            logging.info(f"Processing item: {item}")
-            extract_segments(
-                item,
-                config["SAMPLE_RATE"],
-                config["OUT_PATH_SEGMENTS"],
-                myfs,
-                config["CONNECTION_STRING"],
-                seg_length=3,
-            )
-            saved_count += 1
-        except Exception as e:
-            logging.error(f"Error processing segment {item}: {e}")
+    progress = ExtractProgress(args.progress)
+    if args.full:
+        progress.clear()
+    try:
+        recordings, saved, failed = extract_all(
+            sampled_df,
+            config["SAMPLE_RATE"],
+            config["OUT_PATH_SEGMENTS"],
+            config["CONNECTION_STRING"],
+            seg_length=3,
+            workers=args.workers,
+            progress=progress,
+        )
+    finally:
+        progress.close()
 
-    # Log the total number of saved segments
-    print(f"Number of segments successfully saved for {args.audio_file}: {saved_count}")
\ No newline at end of file
+    print(
+        f"Number of segments successfully saved: {saved} from {recordings} recordings"
+    )
+    if failed:
+        print(
+            f"{failed} recordings failed, see audio_processing.log."
+            " Run again to retry them."
+        )
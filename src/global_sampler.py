@@ -1,32 +1,399 @@
-import pandas as pd
 import argparse
+import pathlib
+import random
+
+import config as cfg
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import yaml
+from detections import DETECTION_SCHEMA, conform_detections, detection_dataset
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--config", default="config_connection.yaml", help="Path to the configuration file.")
-    args = parser.parse_args()
+# Columns identifying a detection, hashed into its sampling key
+KEY_COLUMNS = ["audio", "start", "species"]
+
+# Rows read from the dataset at once
+BATCH_ROWS = 256 * 1024
+
+# Columns added by stratified_sample to rank the detections in their groups
+GROUP_COLUMNS = ["_bin", "_species", "_recording", "_site", "_date"]
+
+
+def sample_segments(
+    segments, num_segments, max_start=3600, random_state=None, by=("species",)
+):
+    """Samples at most ``num_segments`` segments per species across all files.
+
+    Args:
+        segments: DataFrame with one detection per row, as written by
+            ``parse_results.py``.
+        num_segments: Maximum number of segments kept per species.
+        max_start: Only segments starting before this time (s) are kept.
+        random_state: Seed of the sampling, None for a different sample on
+            every run.
+        by: Columns of the groups sampled separately, e.g.
+            ``("species", "site")``.
+
+    Returns:
+        The sampled DataFrame with a unique ``rowid`` column.
+    """
+    # Filter for segments where start < max_start
+    filtered_df = segments[segments["start"] < max_start]
+
+    seed = _seed(random_state)
+    sampled_df = keep_smallest_keys(with_keys(filtered_df, seed), by, num_segments)
+    return _finish(sampled_df)
+
+
+def reservoir_sample(
+    path, num_segments, max_start=3600, min_confidence=None, by=("species",), seed=None
+):
+    """Samples at most ``num_segments`` detections per group from a dataset.
+
+    The dataset is streamed in record batches and only a reservoir of
+    ``num_segments`` rows per group is kept, so memory grows with the number
+    of groups, not with the number of detections. The start time and
+    confidence filters are pushed down to the scan.
+
+    Every detection gets a key hashed from its audio file, start and species
+    with the seed, and the rows with the smallest keys of each group are
+    kept. This is a uniform sample without replacement, and the same seed
+    gives the same sample whatever the partitioning or order of the data,
+    also with ``sample_segments``.
+
+    Args:
+        path: Detection dataset or Parquet file.
+        num_segments: Maximum number of detections kept per group.
+        max_start: Only detections starting before this time (s) are kept.
+        min_confidence: Only detections at least this confident are kept.
+        by: Columns of the groups, e.g. ``("species", "site")``.
+        seed: Seed of the sampling, None for a different sample on every run.
+
+    Returns:
+        The sampled DataFrame with a unique ``rowid`` column.
+    """
+    predicate = ds.field("start") < max_start
+    if min_confidence is not None:
+        predicate = predicate & (ds.field("confidence") >= min_confidence)
+
+    seed = _seed(seed)
+    reservoir = None
+    for table in scan_detections(path, predicate):
+        rows = with_keys(table.to_pandas(), seed)
+        if reservoir is not None:
+            rows = pd.concat([reservoir, rows], ignore_index=True)
+        reservoir = keep_smallest_keys(rows, by, num_segments)
+
+    if reservoir is None:
+        reservoir = with_keys(DETECTION_SCHEMA.empty_table().to_pandas(), seed)
+    return _finish(reservoir)
+
+
+def stratified_sample(
+    path,
+    per_bin,
+    bins=(0.1, 0.25, 0.5, 0.75, 0.9, 1.0),
+    max_per_site=None,
+    max_per_recording=None,
+    max_per_day=None,
+    max_start=3600,
+    min_confidence=None,
+    seed=None,
+):
+    """Samples detections per species and confidence bin, balanced across sites.
+
+    Every species is sampled separately in each confidence bin (stratum).
+    Within a stratum at most ``max_per_recording`` detections are taken
+    from one recording, then at most ``max_per_day`` from one site and day,
+    then at most ``max_per_site`` from one site. The ``per_bin`` detections
+    of the stratum are then taken in turns from every site, so quiet sites
+    are represented as well as busy ones. Detections without site or date
+    count as their own site or day.
+
+    Within these constraints the detections are drawn at random with the
+    sampling keys of ``reservoir_sample``: the same seed gives the same
+    sample. The dataset is streamed and every step is a vectorized ranking
+    of the detections in their groups, so the number of strata does not
+    matter. While streaming, only the detections that pass the first cap
+    (or the ``per_bin`` detections per site and stratum) are kept.
+
+    Args:
+        path: Detection dataset or Parquet file.
+        per_bin: Maximum number of detections per species and bin.
+        bins: Upper edges of the confidence bins, the first bin starts at
+            ``min_confidence`` (or 0).
+        max_per_site: Cap per site and stratum, None for no cap.
+        max_per_recording: Cap per recording and stratum, None for no cap.
+        max_per_day: Cap per site, day and stratum, None for no cap.
+        max_start: Only detections starting before this time (s) are kept.
+        min_confidence: Only detections at least this confident are kept.
+        seed: Seed of the sampling, None for a different sample on every run.
+
+    Returns:
+        The sampled DataFrame with a ``confidence_bin`` and a unique
+        ``rowid`` column.
+    """
+    predicate = ds.field("start") < max_start
+    if min_confidence is not None:
+        predicate = predicate & (ds.field("confidence") >= min_confidence)
+    edges = np.asarray(sorted(bins), dtype=np.float64)
+    labels = _bin_labels(edges, min_confidence)
+
+    # Strata and caps, the first step also bounds the rows kept while
+    # streaming: it keeps the same rows on parts of the data as on all of it
+    stratum = ["_species", "_bin"]
+    steps = [
+        (stratum + group, cap)
+        for group, cap in (
+            (["_recording"], max_per_recording),
+            (["_site", "_date"], max_per_day),
+            (["_site"], max_per_site),
+        )
+        if cap is not None
+    ]
+    steps.append((stratum + ["_site"], per_bin))
+
+    seed = _seed(seed)
+    tables = [_with_strata(DETECTION_SCHEMA.empty_table(), edges, seed)]
+    buffered = kept = 0
+    for table in scan_detections(path, predicate):
+        rows = _with_strata(table, edges, seed)
+        tables.append(rows.filter(pc.less(rows["_bin"], len(edges))))
+        buffered += tables[-1].num_rows
+        # Reduce once the buffer doubled, so every row is ranked a few times
+        if buffered > max(kept, BATCH_ROWS):
+            group, cap = steps[0]
+            reservoir = pa.concat_tables(tables)
+            tables = [reservoir.filter(_group_rank(reservoir, group) < cap)]
+            kept, buffered = tables[0].num_rows, 0
+
+    reservoir = pa.concat_tables(tables)
+    for group, cap in steps:
+        reservoir = reservoir.filter(_group_rank(reservoir, group) < cap)
+
+    # Take the detections of a stratum in turns from every site
+    turn = _group_rank(reservoir, stratum + ["_site"])
+    reservoir = reservoir.filter(_group_rank(reservoir, stratum, turn) < per_bin)
+
+    sampled_df = reservoir.to_pandas()
+    sampled_df["confidence_bin"] = np.asarray(labels, dtype=object)[sampled_df["_bin"]]
+    sampled_df = sampled_df.sort_values(["species", "_bin", "_key"], kind="stable")
+    return _finish(sampled_df.drop(columns=GROUP_COLUMNS))
+
+
+def scan_detections(path, predicate):
+    """Yields the detections of a dataset matching ``predicate``.
+
+    The record batches of the scan, small for a dataset with many
+    partitions, are gathered into tables of about ``BATCH_ROWS`` rows with
+    the ``DETECTION_SCHEMA`` columns.
+    """
+    scanner = detection_dataset(path).scanner(filter=predicate, batch_size=BATCH_ROWS)
+    batches, rows = [], 0
+    for batch in scanner.to_batches():
+        if batch.num_rows:
+            batches.append(batch)
+            rows += batch.num_rows
+        if rows >= BATCH_ROWS:
+            yield conform_detections(pa.Table.from_batches(batches))
+            batches, rows = [], 0
+    if batches:
+        yield conform_detections(pa.Table.from_batches(batches))
+
+
+def _bin_labels(edges, min_confidence):
+    lows = np.concatenate([[min_confidence or 0.0], edges[:-1]])
+    labels = [f"[{low:g}, {high:g})" for low, high in zip(lows, edges, strict=True)]
+    # The last bin includes its upper edge
+    labels[-1] = labels[-1][:-1] + "]"
+    return labels
 
-    with open(args.config) as config_file:
-        config = yaml.load(config_file, Loader=yaml.FullLoader)
 
-    # Read the original Parquet file
-    parquet_df = pd.read_parquet(config["PARQUET_DB"])
+def _with_strata(table, edges, seed):
+    """Adds the confidence bin, sampling key and group columns to a batch.
 
-    # Filter for segments where start < 3600
-    filtered_df = parquet_df[parquet_df["start"] < 3600]
+    The groups are hashes of the species, recording, site and date, so that
+    ranking the rows in their groups only sorts integers. Detections
+    without site or date count as their own site or day.
+    """
+    confidence = table["confidence"].to_numpy()
+    index = np.searchsorted(edges, confidence, side="right")
+    # The last edge is included, detections above it are left out
+    index[confidence == edges[-1]] = len(edges) - 1
 
-    # Limit the total number of segments per species across all files
-    num_segments_per_species = config["NUM_SEGMENTS"]
-    sampled_df = (
-        filtered_df.groupby("species")
-        .apply(lambda x: x.sample(min(len(x), num_segments_per_species), random_state=None))
-        .reset_index(drop=True)
+    hashes = {
+        column: _hash_column(table[column].to_pandas())
+        for column in ("species", "audio", "start", "site", "date")
+    }
+    for column in ("site", "date"):
+        known = pc.is_valid(table[column]).to_numpy()
+        hashes[column] = np.where(known, hashes[column], hashes["audio"])
+    keys = _combine_keys(hashes, seed)
+    return (
+        table.append_column("_bin", pa.array(index.astype(np.int32)))
+        .append_column("_key", pa.array(keys))
+        .append_column("_species", pa.array(hashes["species"]))
+        .append_column("_recording", pa.array(hashes["audio"]))
+        .append_column("_site", pa.array(hashes["site"]))
+        .append_column("_date", pa.array(hashes["date"]))
     )
 
+
+def _group_rank(table, columns, order=None):
+    """Rank of every row in its group, by ``order`` and then by sampling key."""
+    # One 64-bit hash per group, collisions are negligible
+    group = np.zeros(table.num_rows, dtype=np.uint64)
+    for column in columns:
+        group = _mix(group ^ table[column].to_numpy().astype(np.uint64))
+    keys = table["_key"].to_numpy()
+    sort = np.lexsort((keys, group) if order is None else (keys, order, group))
+    sorted_group = group[sort]
+    starts = np.flatnonzero(np.r_[True, sorted_group[1:] != sorted_group[:-1]])
+    counts = np.diff(np.r_[starts, len(sort)])
+    rank = np.empty(len(sort), dtype=np.int64)
+    rank[sort] = np.arange(len(sort)) - np.repeat(starts, counts)
+    return rank
+
+
+def with_keys(segments, seed):
+    """Adds the ``_key`` sampling column, a hash of the detection and the seed."""
+    return segments.assign(_key=sample_keys(segments, seed))
+
+
+def sample_keys(segments, seed):
+    """Sampling keys of the detections of a DataFrame."""
+    return _combine_keys(
+        {column: _hash_column(segments[column]) for column in KEY_COLUMNS}, seed
+    )
+
+
+def _hash_column(values):
+    return pd.util.hash_pandas_object(values, index=False).to_numpy()
+
+
+def _combine_keys(hashes, seed):
+    keys = np.zeros(len(hashes[KEY_COLUMNS[0]]), dtype=np.uint64)
+    for column in KEY_COLUMNS:
+        keys = _mix(keys ^ hashes[column])
+    return _mix(keys + np.uint64(seed))
+
+
+def _mix(x):
+    """splitmix64 finalizer, spreads every input bit over the whole key."""
+    with np.errstate(over="ignore"):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def keep_smallest_keys(segments, by, num_segments):
+    """The ``num_segments`` rows with the smallest ``_key`` of every group."""
+    by = list(by)
+    return (
+        segments.sort_values(by + ["_key"], kind="stable")
+        .groupby(by, dropna=False, sort=False)
+        .head(num_segments)
+    )
+
+
+def _seed(seed):
+    return random.getrandbits(64) if seed is None else int(seed) % 2**64
+
+
+def _finish(sampled_df):
+    columns = [c for c in DETECTION_SCHEMA.names if c in sampled_df.columns]
+    columns += [c for c in sampled_df.columns if c not in columns and c != "_key"]
+    sampled_df = sampled_df[columns].reset_index(drop=True)
+
     # Add a unique row identifier
-    sampled_df['rowid'] = range(len(sampled_df))
+    sampled_df["rowid"] = range(len(sampled_df))
+    return sampled_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--config",
+        default="config_connection.yaml",
+        help="Path to the configuration file.",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=cfg.RANDOM_SEED, help="Seed of the sampling."
+    )
+    parser.add_argument(
+        "--by",
+        nargs="+",
+        default=["species"],
+        help="Columns of the sampled groups, e.g. species site.",
+    )
+    parser.add_argument(
+        "--max_start",
+        type=float,
+        default=3600,
+        help="Only sample detections starting before this time (s).",
+    )
+    parser.add_argument(
+        "--min_confidence",
+        type=float,
+        default=None,
+        help="Only sample detections at least this confident.",
+    )
+    parser.add_argument(
+        "--bins",
+        nargs="+",
+        type=float,
+        default=None,
+        help="Upper edges of confidence bins, e.g. 0.25 0.5 0.75 1."
+        " Samples NUM_SEGMENTS per species and bin.",
+    )
+    parser.add_argument(
+        "--max_per_site",
+        type=int,
+        default=None,
+        help="With --bins, cap per site, species and bin.",
+    )
+    parser.add_argument(
+        "--max_per_recording",
+        type=int,
+        default=None,
+        help="With --bins, cap per recording, species and bin.",
+    )
+    parser.add_argument(
+        "--max_per_day",
+        type=int,
+        default=None,
+        help="With --bins, cap per site, day, species and bin.",
+    )
+    args = parser.parse_args()
+
+    with pathlib.Path(args.config).open() as config_file:
+        config = yaml.safe_load(config_file)
+
+    if args.bins:
+        sampled_df = stratified_sample(
+            config.get("PARQUET_DB", "sample.parquet"),
+            config["NUM_SEGMENTS"],
+            bins=args.bins,
+            max_per_site=args.max_per_site,
+            max_per_recording=args.max_per_recording,
+            max_per_day=args.max_per_day,
+            max_start=args.max_start,
+            min_confidence=args.min_confidence,
+            seed=args.seed,
+        )
+    else:
+        sampled_df = reservoir_sample(
+            config.get("PARQUET_DB", "sample.parquet"),
+            config["NUM_SEGMENTS"],
+            max_start=args.max_start,
+            min_confidence=args.min_confidence,
+            by=args.by,
+            seed=args.seed,
+        )
 
     # Save the globally sampled DataFrame to a new parquet file
-    sampled_df.to_parquet(config["TO_EXTRACT_FILE"])
-    print(f"Global sampling complete. Saved to {config['TO_EXTRACT_FILE']}")
+    to_extract_file = config.get("TO_EXTRACT_FILE", "sampled_segments.parquet")
+    sampled_df.to_parquet(to_extract_file)
+    print(f"Global sampling complete. Saved to {to_extract_file}")
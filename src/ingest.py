@@ -0,0 +1,327 @@
+import json
+import logging
+import os
+import pathlib
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from detections import (
+    DETECTION_SCHEMA,
+    MAX_ROWS_PER_GROUP,
+    detection_dataset,
+    write_detections,
+)
+
+# State of the ingestion, kept in the dataset folder. Files starting with
+# "_" or "." are not part of the dataset for pyarrow.
+STATE_FILE = "_ingest.sqlite"
+STAGING_PREFIX = ".staging-"
+PLAN_FILE = "plan.json"
+
+
+class IngestState:
+    """SQLite record of the result files already in a detection dataset.
+
+    A result file is up to date when its path, size and modification time
+    match the ones it had when it was ingested. The parameters of the
+    ingestion (threshold, partitioning, site pattern) are stored too, a
+    dataset built with other parameters has to be rebuilt.
+
+    Args:
+        path: Path of the SQLite database, created if needed.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute(
+            """CREATE TABLE IF NOT EXISTS results (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime REAL,
+                audio TEXT,
+                ingested REAL
+            )"""
+        )
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+
+    def get(self, key):
+        with self.lock:
+            row = self.con.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value):
+        with self.lock:
+            self.con.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def results(self):
+        """{result path: (size, mtime, audio)} of the ingested result files."""
+        with self.lock:
+            rows = self.con.execute(
+                "SELECT path, size, mtime, audio FROM results"
+            ).fetchall()
+        return {path: (size, mtime, audio) for path, size, mtime, audio in rows}
+
+    def update(self, ingested, removed, key=None, value=None):
+        """Records ingested ``(path, size, mtime, audio)`` and removed paths.
+
+        The optional ``key``/``value`` is set in the same transaction.
+        """
+        now = time.time()
+        with self.lock:
+            self.con.execute("BEGIN")
+            try:
+                self.con.executemany(
+                    "DELETE FROM results WHERE path = ?", [(p,) for p in removed]
+                )
+                self.con.executemany(
+                    "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                    [(*row, now) for row in ingested],
+                )
+                if key is not None:
+                    self.con.execute(
+                        "INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value)
+                    )
+            except Exception:
+                self.con.execute("ROLLBACK")
+                raise
+            self.con.execute("COMMIT")
+
+    def close(self):
+        self.con.close()
+
+
+def ingest_params(threshold, partition_by, site_pattern):
+    """The settings that change the content or layout of the dataset."""
+    return json.dumps(
+        {
+            "threshold": threshold,
+            "partition_by": list(partition_by or []),
+            "site_pattern": site_pattern,
+        },
+        sort_keys=True,
+    )
+
+
+def ingest_detections(
+    pairs, path, read_tables, params, partition_by=("species",), full=False
+):
+    """Brings the detection dataset at ``path`` up to date with the result files.
+
+    Only the result files that are new or whose size or modification time
+    changed are parsed, their rows are appended to the dataset. The rows of
+    changed and deleted result files are removed from the data files that
+    hold them. All the new and rewritten data files are written to a
+    staging folder first and then moved into place, each with an atomic
+    rename. The moves are journaled, so an interrupted run is completed by
+    the next one.
+
+    The dataset is rebuilt from scratch with ``full``, when it does not
+    exist yet, or when it was built with other ``params``.
+
+    Args:
+        pairs: ``(audio, result)`` paths of the matched files.
+        path: Folder of the detection dataset.
+        read_tables: Function of a list of pairs that yields the tables of
+            detections of their result files, with the ``DETECTION_SCHEMA``
+            columns.
+        params: ``ingest_params`` of the run.
+        partition_by: Partition columns of the dataset.
+        full: Rebuild the whole dataset.
+
+    Returns:
+        The number of result files parsed and of detection rows written.
+    """
+    pairs = [(audio, result) for audio, result in pairs]
+    stats = {result: _stat(result) for _audio, result in pairs}
+
+    state_path = pathlib.Path(path) / STATE_FILE
+    if not full and not state_path.is_file():
+        full = True
+    if not full:
+        _recover(path)
+        state = IngestState(state_path)
+        if state.get("params") != params:
+            logging.info("Ingestion parameters changed, rebuilding the dataset.")
+            state.close()
+            full = True
+    if full:
+        return _rebuild(pairs, stats, path, read_tables, params, partition_by)
+
+    known = state.results()
+    todo = [
+        (audio, result)
+        for audio, result in pairs
+        if known.get(result, (None, None))[:2] != stats[result]
+    ]
+    current = set(stats)
+    removed = [result for result in known if result not in current]
+    # Rows of the previous version of changed files, and of deleted files
+    stale = {known[result][2] for _audio, result in todo if result in known}
+    stale |= {known[result][2] for result in removed}
+
+    if not todo and not removed:
+        logging.info("Detection dataset is up to date.")
+        state.close()
+        return 0, 0
+
+    run = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    staging = pathlib.Path(path) / (STAGING_PREFIX + run)
+    plan = []
+
+    if stale:
+        plan.extend(_stage_without(path, staging, sorted(stale)))
+
+    new_dir = staging / "new"
+    rows = write_detections(
+        read_tables(todo),
+        str(new_dir),
+        partition_by,
+        basename_template=f"part-{run}-{{i}}.parquet",
+    )
+    for src in sorted(new_dir.rglob("*")):
+        if src.is_file():
+            dst = pathlib.Path(path) / src.relative_to(new_dir)
+            plan.append(["replace", str(src), str(dst)])
+
+    staging.mkdir(parents=True, exist_ok=True)
+    with (staging / PLAN_FILE).open("w") as f:
+        json.dump(plan, f)
+
+    state.update(
+        [(result, *stats[result], audio) for audio, result in todo],
+        removed,
+        key="pending",
+        value=str(staging),
+    )
+    _apply(staging)
+    state.set("pending", None)
+    state.close()
+
+    logging.info(
+        f"Ingested {len(todo)} result files ({rows} detections), "
+        f"removed {len(removed)} result files."
+    )
+    return len(todo), rows
+
+
+def _rebuild(pairs, stats, path, read_tables, params, partition_by):
+    """Builds the dataset from all the result files and swaps it in at ``path``."""
+    run = uuid.uuid4().hex[:8]
+    tmp = f"{path.rstrip('/')}.tmp-{run}"
+    rows = write_detections(read_tables(pairs), tmp, partition_by)
+
+    state = IngestState(pathlib.Path(tmp) / STATE_FILE)
+    state.update(
+        [(result, *stats[result], audio) for audio, result in pairs],
+        [],
+        key="params",
+        value=params,
+    )
+    state.close()
+
+    old = pathlib.Path(f"{path.rstrip('/')}.old-{run}")
+    if pathlib.Path(path).exists():
+        pathlib.Path(path).rename(old)
+    pathlib.Path(tmp).rename(path)
+    if old.is_dir():
+        shutil.rmtree(old)
+    else:
+        old.unlink(missing_ok=True)
+    logging.info(
+        f"Rebuilt the detection dataset: {len(pairs)} result files, {rows} detections."
+    )
+    return len(pairs), rows
+
+
+def _stage_without(path, staging, audio_files):
+    """Writes the data files holding rows of ``audio_files`` without them.
+
+    Returns:
+        The plan entries replacing or deleting the original data files.
+    """
+    plan = []
+    stale = ds.field("audio").isin(audio_files)
+    for fragment in detection_dataset(path).get_fragments():
+        if not fragment.to_table(columns=["audio"], filter=stale).num_rows:
+            continue
+        parquet_file = pq.ParquetFile(fragment.path)
+        table = parquet_file.read()
+        kept = table.filter(
+            pc.invert(
+                pc.is_in(
+                    table["audio"],
+                    value_set=pa.array(
+                        audio_files, DETECTION_SCHEMA.field("audio").type
+                    ),
+                )
+            )
+        )
+        rel = os.path.relpath(fragment.path, path)
+        if kept.num_rows:
+            staged = pathlib.Path(staging) / "rewrite" / rel
+            staged.parent.mkdir(parents=True, exist_ok=True)
+            pq.write_table(
+                kept,
+                str(staged),
+                row_group_size=MAX_ROWS_PER_GROUP,
+                compression="zstd",
+            )
+            plan.append(["replace", str(staged), fragment.path])
+        else:
+            plan.append(["delete", None, fragment.path])
+    return plan
+
+
+def _apply(staging):
+    """Moves the staged files of a run into place, then removes the staging folder.
+
+    Every step can be repeated, so an interrupted run is completed by
+    applying its plan again.
+    """
+    with (pathlib.Path(staging) / PLAN_FILE).open() as f:
+        plan = json.load(f)
+    for op, src, dst in plan:
+        if op == "replace" and pathlib.Path(src).exists():
+            pathlib.Path(dst).parent.mkdir(parents=True, exist_ok=True)
+            pathlib.Path(src).replace(dst)
+        elif op == "delete":
+            pathlib.Path(dst).unlink(missing_ok=True)
+    shutil.rmtree(staging)
+
+
+def _recover(path):
+    """Completes or discards the interrupted runs of the dataset at ``path``."""
+    state = IngestState(pathlib.Path(path) / STATE_FILE)
+    pending = state.get("pending")
+    for staging in pathlib.Path(path).iterdir():
+        if not staging.name.startswith(STAGING_PREFIX):
+            continue
+        is_pending = pending is not None and staging == pathlib.Path(pending)
+        if is_pending and (staging / PLAN_FILE).exists():
+            # The state already records the run, its files have to be moved
+            logging.info(f"Completing the interrupted ingestion {staging.name}")
+            _apply(staging)
+        else:
+            shutil.rmtree(staging)
+    state.set("pending", None)
+    state.close()
+
+
+def _stat(path):
+    stat = pathlib.Path(path).stat()
+    return stat.st_size, stat.st_mtime
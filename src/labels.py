@@ -0,0 +1,29 @@
+from postprocess import species_mask
+
+
+class LabelRegistry:
+    """Lookup tables for the model labels, built once at startup.
+
+    Args:
+        labels: The model labels, ``<scientific name>_<common name>``.
+        translated_labels: Optional translated labels, same order as ``labels``.
+        codes: Optional mapping of label to eBird code.
+        species_list: Optional list of labels to report, empty keeps all.
+    """
+
+    def __init__(self, labels, translated_labels=None, codes=None, species_list=None):
+        codes = codes or {}
+        self.labels = list(labels)
+        self.index = {label: i for i, label in enumerate(self.labels)}
+        self.common_names = [
+            label.split("_", 1)[-1] for label in (translated_labels or self.labels)
+        ]
+        self.codes = [codes.get(label, label) for label in self.labels]
+        self.species_mask = species_mask(self.labels, species_list)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def mask_for(self, species_list):
+        """Species mask for another species list, without rebuilding the tables."""
+        return species_mask(self.labels, species_list)
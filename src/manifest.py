@@ -0,0 +1,143 @@
+import argparse
+import hashlib
+import json
+import pathlib
+import sqlite3
+import threading
+import time
+
+import config as cfg
+import fsspec
+from connections import get_pool, split_pooled_url
+
+
+def file_stat(path):
+    """Size and modification time of a local or remote (fsspec) file."""
+    pooled = split_pooled_url(path)
+    if pooled is not None:
+        connection_string, fs_path = pooled
+        info = get_pool(connection_string).getinfo(fs_path, namespaces=["details"])
+        return int(info.size or 0), float(info.raw["details"].get("modified") or 0)
+
+    filesystem, fs_path = fsspec.core.url_to_fs(path)
+    info = filesystem.info(fs_path)
+    mtime = info.get("mtime", info.get("LastModified", info.get("created", 0)))
+    if hasattr(mtime, "timestamp"):
+        mtime = mtime.timestamp()
+    return int(info.get("size") or 0), float(mtime or 0)
+
+
+def analysis_params(species_list):
+    """Hash of the settings that change the results of an analysis."""
+    params = {
+        "MODEL_VERSION": cfg.MODEL_VERSION,
+        "SAMPLE_RATE": cfg.SAMPLE_RATE,
+        "SIG_LENGTH": cfg.SIG_LENGTH,
+        "SIG_OVERLAP": cfg.SIG_OVERLAP,
+        "SIG_MINLEN": cfg.SIG_MINLEN,
+        "BANDPASS_FMIN": cfg.BANDPASS_FMIN,
+        "BANDPASS_FMAX": cfg.BANDPASS_FMAX,
+        "MIN_CONFIDENCE": cfg.MIN_CONFIDENCE,
+        "TOP_K": cfg.TOP_K,
+        "SILENCE_GATE": cfg.SILENCE_GATE,
+        "SILENCE_THRESHOLD_DB": cfg.SILENCE_THRESHOLD_DB if cfg.SILENCE_GATE else None,
+        "LOCATION_FILTER": cfg.LOCATION_FILTER,
+        "LOCATION_FILTER_THRESHOLD": cfg.LOCATION_FILTER_THRESHOLD,
+        "LOCATION": _location_params() if cfg.LOCATION_FILTER else None,
+        "SPECIES_LIST": hashlib.sha1(  # noqa: S324
+            "\n".join(sorted(species_list)).encode()
+        ).hexdigest(),
+    }
+    return hashlib.sha1(  # noqa: S324
+        json.dumps(params, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def _location_params():
+    """The settings locating the recordings for the species filter."""
+    site_table = None
+    if cfg.SITE_TABLE:
+        site_table = pathlib.Path(cfg.SITE_TABLE).read_bytes()
+        site_table = hashlib.sha1(site_table).hexdigest()  # noqa: S324
+    return {
+        "SITE_TABLE": site_table,
+        "SITE_PATTERN": cfg.SITE_PATTERN,
+        "LATITUDE": cfg.LATITUDE,
+        "LONGITUDE": cfg.LONGITUDE,
+        "WEEK": cfg.WEEK,
+    }
+
+
+class RunManifest:
+    """SQLite record of the files already analysed and how.
+
+    A file is up to date when its path, size, modification time and analysis
+    parameters all match the last successful run. The database can be shared
+    by several worker processes and threads.
+
+    Args:
+        path: Path of the SQLite database, created if needed.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute(
+            """CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime REAL,
+                params TEXT,
+                result TEXT,
+                finished REAL
+            )"""
+        )
+
+    def is_current(self, path, size, mtime, params):
+        with self.lock:
+            row = self.con.execute(
+                "SELECT size, mtime, params FROM files WHERE path = ?", (str(path),)
+            ).fetchone()
+        return row is not None and tuple(row) == (size, mtime, params)
+
+    def record(self, path, size, mtime, params, result=None):
+        with self.lock:
+            self.con.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                (str(path), size, mtime, params, result, time.time()),
+            )
+
+    def pending(self, paths, params):
+        """Yields the paths that are new, changed or analysed with other parameters."""
+        for path in paths:
+            try:
+                current = self.is_current(path, *file_stat(path), params)
+            except OSError:
+                current = False
+            if not current:
+                yield path
+
+    def close(self):
+        self.con.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="List the files of a file list that still need to be analysed."
+    )
+    parser.add_argument("file_list", help="File listing one audio path per line.")
+    parser.add_argument("--manifest", default=cfg.MANIFEST_FILE)
+    parser.add_argument("--species_list", default="species_list.txt")
+    args = parser.parse_args()
+
+    with pathlib.Path(args.species_list).open() as sl:
+        params = analysis_params([line.strip() for line in sl if line.strip()])
+
+    manifest = RunManifest(args.manifest)
+    with pathlib.Path(args.file_list).open() as fl:
+        paths = [line.strip() for line in fl if line.strip()]
+    for path in manifest.pending(paths, params):
+        print(path)
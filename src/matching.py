@@ -0,0 +1,114 @@
+import logging
+import posixpath
+import re
+from collections import namedtuple
+
+import pyarrow as pa
+
+# Suffixes BirdNET appends to the audio path, e.g.
+# SITE/20240501_120000.BirdNET.selection.table.txt
+RESULT_SUFFIX = re.compile(r"(\.BirdNET\..*|\.selection\.table\.txt)$", re.IGNORECASE)
+TABLE_SUFFIX = ".selection.table.txt"
+
+MATCH_SCHEMA = pa.schema(
+    [
+        ("audio", pa.string()),
+        ("result", pa.string()),
+        ("key", pa.string()),
+        ("matched_by", pa.string()),
+    ]
+)
+
+FileMatch = namedtuple("FileMatch", ["pairs", "unmatched_audio", "orphan_results"])
+
+
+def strip_extension(path):
+    """Path without its extension, the directories are kept.
+
+    Result files lose the whole BirdNET suffix, so ``SITE/a.WAV`` and
+    ``SITE/a.BirdNET.selection.table.txt`` both give ``SITE/a``.
+    """
+    path = str(path).replace("\\", "/")
+    directory, name = posixpath.split(path)
+    stripped = RESULT_SUFFIX.sub("", name)
+    if stripped == name:
+        stripped = posixpath.splitext(name)[0]
+    return posixpath.join(directory, stripped)
+
+
+def relative_key(path, root=""):
+    """Normalized path of a file relative to ``root``, without extension."""
+    path = str(path).replace("\\", "/")
+    # Remote URLs (ssh://host/...) are keyed by their path
+    if "://" in path:
+        path = path.split("://", 1)[1].partition("/")[2]
+    root = str(root or "").replace("\\", "/")
+    if "://" in root:
+        root = root.split("://", 1)[1].partition("/")[2]
+    path = posixpath.normpath("/" + path.lstrip("/"))
+    root = posixpath.normpath("/" + root.lstrip("/"))
+    if root != "/" and (path + "/").startswith(root + "/"):
+        path = path[len(root) :]
+    return strip_extension(path.lstrip("/"))
+
+
+def match_files(audio_files, result_files, audio_root="", result_root=""):
+    """Matches audio files with their result files in linear time.
+
+    Both sides are keyed by their path relative to their root, without
+    extension. A result whose key is not an audio key is matched by the
+    longest trailing part of its key that is (for results written with
+    another input root), then by its stem if a single audio file has it.
+
+    Args:
+        audio_files: Paths or URLs of the audio files.
+        result_files: Paths of the result files.
+        audio_root: Folder the audio paths are relative to.
+        result_root: Folder the result paths are relative to.
+
+    Returns:
+        A ``FileMatch`` with the matched pairs as an Arrow table (columns
+        ``audio``, ``result``, ``key``, ``matched_by``), the audio files
+        without result and the results without audio file.
+    """
+    by_key = {}
+    by_stem = {}
+    for audio in audio_files:
+        key = relative_key(audio, audio_root)
+        if key in by_key:
+            logging.warning(f"{audio} has the same key as {by_key[key]}, ignored")
+            continue
+        by_key[key] = audio
+        stem = posixpath.basename(key)
+        # Stems shared by several files cannot be matched by stem
+        by_stem[stem] = None if stem in by_stem else key
+
+    columns = {name: [] for name in MATCH_SCHEMA.names}
+    matched = set()
+    orphans = []
+    for result in result_files:
+        key = relative_key(result, result_root)
+        parts = key.split("/")
+        found, how = None, "path"
+        for i in range(len(parts)):
+            if "/".join(parts[i:]) in by_key:
+                found = "/".join(parts[i:])
+                break
+        if found is None:
+            found, how = by_stem.get(parts[-1]), "stem"
+        if found is None:
+            orphans.append(result)
+            continue
+        matched.add(found)
+        columns["audio"].append(by_key[found])
+        columns["result"].append(result)
+        columns["key"].append(found)
+        columns["matched_by"].append(how)
+
+    unmatched = [audio for key, audio in by_key.items() if key not in matched]
+    return FileMatch(pa.table(columns, schema=MATCH_SCHEMA), unmatched, orphans)
+
+
+def is_result_table(path):
+    """Whether a file is a Raven selection table."""
+    return str(path).lower().endswith(TABLE_SUFFIX)
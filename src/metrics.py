@@ -0,0 +1,160 @@
+import contextlib
+import json
+import pathlib
+import threading
+import time
+from collections import defaultdict
+
+STAGES = ["fetch", "decode", "resample", "split", "predict", "postprocess", "write"]
+
+
+class FileMetrics:
+    """Per-stage durations and counters of one analysed file.
+
+    Stage durations are in seconds and accumulate over repeated calls, so
+    a stage that runs once per window or batch reports its total.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.started = time.time()
+        self._t0 = time.perf_counter()
+        self.wall = None
+        self.stages = defaultdict(float)
+        self.counters = defaultdict(float)
+
+    @contextlib.contextmanager
+    def stage(self, name, exclude=()):
+        """Times a stage, minus the ``exclude`` stages measured within it."""
+        nested = sum(self.stages[n] for n in exclude)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            nested = sum(self.stages[n] for n in exclude) - nested
+            self.stages[name] += time.perf_counter() - t0 - nested
+
+    def add_time(self, name, seconds):
+        self.stages[name] += seconds
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def finish(self):
+        """Stops the wall clock of the file and returns its record."""
+        if self.wall is None:
+            self.wall = time.perf_counter() - self._t0
+        return self.to_dict()
+
+    def to_dict(self):
+        wall = self.wall if self.wall is not None else time.perf_counter() - self._t0
+        audio_seconds = self.counters.get("audio_seconds", 0.0)
+        return {
+            "file": self.path,
+            "started": self.started,
+            "wall_s": round(wall, 4),
+            "stages": {name: round(self.stages.get(name, 0.0), 4) for name in STAGES},
+            "bytes_read": int(self.counters.get("bytes_read", 0)),
+            "audio_seconds": round(audio_seconds, 3),
+            "chunks": int(self.counters.get("chunks", 0)),
+            "skipped_chunks": int(self.counters.get("skipped_chunks", 0)),
+            "realtime_factor": round(audio_seconds / wall, 2) if wall else None,
+        }
+
+
+class MeteredFile:
+    """File object wrapper counting the bytes read and the time spent reading."""
+
+    def __init__(self, f, metrics):
+        self._f = f
+        self._metrics = metrics
+
+    def read(self, *args):
+        t0 = time.perf_counter()
+        data = self._f.read(*args)
+        self._metrics.add_time("fetch", time.perf_counter() - t0)
+        self._metrics.count("bytes_read", len(data))
+        return data
+
+    def readinto(self, b):
+        t0 = time.perf_counter()
+        n = self._f.readinto(b)
+        self._metrics.add_time("fetch", time.perf_counter() - t0)
+        self._metrics.count("bytes_read", n or 0)
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+class RunMetrics:
+    """Aggregates the per-file metrics of a run.
+
+    Args:
+        path: JSON-lines file the run summary is appended to, None to only
+            return it.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self.files = 0
+        self.failed = 0
+        self.totals = defaultdict(float)
+        self.stages = defaultdict(float)
+        self._t0 = time.perf_counter()
+
+    def add(self, record):
+        """Adds the record of one file to the run totals."""
+        with self._lock:
+            self.files += 1
+            for key in ("bytes_read", "audio_seconds", "chunks", "skipped_chunks"):
+                self.totals[key] += record[key]
+            for name, seconds in record["stages"].items():
+                self.stages[name] += seconds
+
+    def fail(self):
+        """Counts a file that could not be analysed."""
+        with self._lock:
+            self.failed += 1
+
+    def summary(self):
+        elapsed = time.perf_counter() - self._t0
+        busy = sum(self.stages.values())
+        return {
+            "type": "summary",
+            "files": self.files,
+            "failed": self.failed,
+            "elapsed_s": round(elapsed, 3),
+            "audio_hours": round(self.totals["audio_seconds"] / 3600, 3),
+            "bytes_read": int(self.totals["bytes_read"]),
+            "chunks": int(self.totals["chunks"]),
+            "skipped_chunks": int(self.totals["skipped_chunks"]),
+            "skipped_fraction": (
+                round(self.totals["skipped_chunks"] / self.totals["chunks"], 4)
+                if self.totals["chunks"]
+                else 0.0
+            ),
+            "realtime_factor": (
+                round(self.totals["audio_seconds"] / elapsed, 2) if elapsed else None
+            ),
+            "stages_s": {name: round(self.stages[name], 3) for name in STAGES},
+            "stages_share": {
+                name: round(self.stages[name] / busy, 3) if busy else 0.0
+                for name in STAGES
+            },
+        }
+
+    def close(self):
+        """Writes and returns the run summary."""
+        summary = self.summary()
+        if self.path:
+            append_jsonl(self.path, summary)
+        return summary
+
+
+def append_jsonl(path, record):
+    """Appends one JSON line, in a single write so that processes can share a file."""
+    pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with pathlib.Path(path).open("a") as f:
+        f.write(json.dumps(record) + "\n")
@@ -1,16 +1,40 @@
 import argparse
+import collections
+import concurrent.futures
 import glob
 import logging
+import multiprocessing
 import os
+import pathlib
 
+import config as cfg
 import fs
 import numpy as np
 import pyarrow as pa
-import pyarrow.parquet as pq
+import pyarrow.compute as pc
+import pyarrow.csv
 import yaml
-from tenacity import retry, wait_exponential
+from catalog import AUDIO_PATTERNS, open_catalog
+from connections import get_pool
+from detections import SEGMENT_SCHEMA, add_site_columns
+from ingest import ingest_detections, ingest_params
+from matching import is_result_table, match_files
+from raven import RAVEN_TABLE_HEADER
+
+RAVEN_HEADER = RAVEN_TABLE_HEADER.rstrip("\n")
+RAVEN_COLUMNS = RAVEN_HEADER.split("\t")
+
+# Selection table columns read into the segments table
+SEGMENT_COLUMNS = {
+    "Begin Time (s)": ("start", pa.float64()),
+    "End Time (s)": ("end", pa.float64()),
+    "Common Name": ("species", pa.string()),
+    "Confidence": ("confidence", pa.float64()),
+}
+
+# Result files parsed per task of the process pool
+TABLES_PER_TASK = 256
 
-from utils import remove_extension
 
 def setup_logging():
     logging.basicConfig(
@@ -20,76 +44,203 @@ def setup_logging():
         datefmt="%Y-%m-%d %H:%M:%S",
     )
 
-@retry(wait=wait_exponential(multiplier=1, min=4, max=120))
+
 def do_connection(connection_string):
-    """Establish a connection to the filesystem with retries."""
-    try:
-        if connection_string:
-            return fs.open_fs(connection_string)
-        return False
-    except Exception as e:
-        logging.error(f"Attempt failed to connect to filesystem: {e}")
-        logging.info("Retrying connection...")
-        raise
+    """Pooled connections to the filesystem, opened with retries on first use."""
+    if connection_string:
+        return get_pool(connection_string)
+    return False
+
 
 def walk_audio(filesystem, input_path):
     """Walk through the filesystem and yield audio files."""
-    walker = filesystem.walk(
-        input_path,
-        filter=["*.wav", "*.flac", "*.mp3", "*.ogg", "*.m4a", "*.WAV", "*.MP3"],
-    )
+    walker = filesystem.walk(input_path, filter=AUDIO_PATTERNS)
     for path, _dirs, flist in walker:
         for f in flist:
             yield fs.path.combine(path, f.name)
 
-def parse_folders(filesystem, apath, rpath):
+
+def parse_folders(filesystem, apath, rpath, catalog=None):
     """
     Parse audio and result folders, matching audio files with their corresponding result files.
+
+    With a ``catalog.FileCatalog``, the remote audio files are read from the
+    catalog, which is refreshed first, instead of walking the whole tree.
     """
-    audio_files = get_audio_files(filesystem, apath)
-    audio_no_extension = [remove_extension(audio_file) for audio_file in audio_files]
+    audio_files = get_audio_files(filesystem, apath, catalog)
 
     result_files = [
         f
         for f in glob.glob(rpath + "/**/*", recursive=True)
-        if os.path.isfile(f)
+        if pathlib.Path(f).is_file() and is_result_table(f)
     ]
-    matched_files = match_audio_and_results(
-        audio_files, audio_no_extension, result_files
-    )
+    match = match_audio_and_results(audio_files, result_files, apath, rpath)
+
+    logging.info(f"Found {len(match.pairs)} audio files with valid result file.")
+    if match.unmatched_audio:
+        logging.info(f"{len(match.unmatched_audio)} audio files have no result file.")
+    if match.orphan_results:
+        logging.warning(f"{len(match.orphan_results)} result files have no audio file.")
+    return match
 
-    logging.info(f"Found {len(matched_files)} audio files with valid result file.")
-    return matched_files
 
-def get_audio_files(filesystem, apath):
+def get_audio_files(filesystem, apath, catalog=None):
     """Get all audio files from the specified path."""
     if not filesystem:
         audio_files = [
             f
             for f in glob.glob(apath + "/**/*", recursive=True)
-            if os.path.isfile(f)
+            if pathlib.Path(f).is_file()
         ]
         return [f for f in audio_files if f.endswith((".WAV", ".wav", ".mp3"))]
+    elif catalog is not None:
+        catalog.refresh(filesystem, apath)
+        return [path for path, _size, _mtime in catalog.files(apath, AUDIO_PATTERNS)]
     else:
         return [audiofile for audiofile in walk_audio(filesystem, apath)]
 
-def match_audio_and_results(audio_files, audio_no_extension, result_files):
-    """Match audio files with their corresponding result files."""
-    matched_files = []
-    for result in result_files:
-        result_no_extension = remove_extension(result)
-        if result_no_extension in audio_no_extension:
-            audio_idx = audio_no_extension.index(result_no_extension)
-            matched_files.append({"audio": audio_files[audio_idx], "result": result})
-    return matched_files
-
-def parse_files(file_list, max_segments=10, threshold=0.6):
-    """Parse the file list and make a list of segments."""
-    segments = []
-    for files in file_list:
-        segments.extend(find_segments(files["audio"], files["result"], threshold))
-    logging.info(f"Found {len(segments)} segments in total.")
-    return segments
+
+def match_audio_and_results(audio_files, result_files, apath="", rpath=""):
+    """Match audio files with their corresponding result files.
+
+    Files are matched by their path relative to ``apath`` and ``rpath``,
+    see ``matching.match_files``.
+    """
+    return match_files(audio_files, result_files, apath, rpath)
+
+
+def write_match_report(match, path):
+    """Write the audio files without result and the orphan results to a CSV."""
+    table = pa.table(
+        {
+            "kind": ["unmatched_audio"] * len(match.unmatched_audio)
+            + ["orphan_result"] * len(match.orphan_results),
+            "path": list(match.unmatched_audio) + list(match.orphan_results),
+        }
+    )
+    pyarrow.csv.write_csv(table, path)
+
+
+def parse_files(file_list, max_segments=10, threshold=0.6, workers=1):
+    """Parse the file list and make a list of segments.
+
+    ``file_list`` is the table of matched pairs of ``parse_folders`` or a
+    list of ``{"audio": ..., "result": ...}`` dicts.
+    """
+    return parse_tables(file_list, threshold, workers).to_pylist()
+
+
+def parse_tables(file_list, threshold=0.6, workers=None):
+    """Read the segments of all result files into one Arrow table.
+
+    Returns:
+        A table with the ``SEGMENT_SCHEMA`` columns.
+    """
+    table = pa.concat_tables(
+        [SEGMENT_SCHEMA.empty_table()]
+        + list(iter_segment_tables(file_list, threshold, workers))
+    )
+    logging.info(f"Found {table.num_rows} segments in total.")
+    return table
+
+
+def iter_segment_tables(file_list, threshold=0.6, workers=None):
+    """Yield the segments of the result files, one table per batch of files.
+
+    The selection tables are parsed by ``read_segments_batch``, in batches of
+    ``TABLES_PER_TASK`` files spread over a pool of ``workers`` processes
+    (all CPUs by default, in this process if 1). At most two batches per
+    worker are in flight, so a slow consumer bounds the memory used.
+    """
+    if isinstance(file_list, pa.Table):
+        file_list = file_list.select(["audio", "result"]).to_pylist()
+    pairs = [(files["audio"], files["result"]) for files in file_list]
+    tasks = [
+        pairs[i : i + TABLES_PER_TASK] for i in range(0, len(pairs), TABLES_PER_TASK)
+    ]
+    workers = workers or os.cpu_count() or 1
+
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield read_segments_batch(task, threshold)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(
+        min(workers, len(tasks)), mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(executor.submit(read_segments_batch, task, threshold))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_segments_batch(pairs, threshold):
+    """Segments of a batch of ``(audio, result)`` pairs, as one table.
+
+    The rows of all the selection tables with the ``RAVEN_TABLE_HEADER``
+    columns are parsed at once by a vectorized TSV reader, and the
+    confidence threshold is applied as a compute filter. Tables with other
+    columns are read by ``find_segments``.
+    """
+    bodies, audio_files, counts, others = [], [], [], []
+    for audio_file, result_file in pairs:
+        with pathlib.Path(result_file).open("rb") as rf:
+            header = rf.readline()
+            body = rf.read()
+        if header.decode("utf-8", "replace").rstrip("\r\n") != RAVEN_HEADER:
+            others.append((audio_file, result_file))
+            continue
+        body = body.rstrip(b"\r\n")
+        if body:
+            body += b"\n"
+        bodies.append(body)
+        audio_files.append(audio_file)
+        counts.append(body.count(b"\n"))
+
+    try:
+        table = read_raven_rows(b"".join(bodies))
+    except pa.ArrowInvalid:
+        table = None
+    if table is None or table.num_rows != sum(counts):
+        # Blank or malformed lines: the rows cannot be told apart per file
+        table = None
+        others = list(pairs)
+
+    tables = [SEGMENT_SCHEMA.empty_table()]
+    if table is not None:
+        indices = np.repeat(np.arange(len(audio_files)), counts)
+        audio = pc.take(pa.array(audio_files, pa.string()), pa.array(indices))
+        table = table.add_column(0, "audio", audio)
+        tables.append(table.filter(pc.greater_equal(table["confidence"], threshold)))
+    tables.extend(
+        pa.Table.from_pylist(
+            find_segments(audio_file, result_file, threshold), schema=SEGMENT_SCHEMA
+        )
+        for audio_file, result_file in others
+    )
+    return pa.concat_tables(tables)
+
+
+def read_raven_rows(data):
+    """Segment columns of the rows of selection tables, without header."""
+    table = pyarrow.csv.read_csv(
+        pa.py_buffer(data),
+        read_options=pyarrow.csv.ReadOptions(
+            column_names=RAVEN_COLUMNS, use_threads=False
+        ),
+        parse_options=pyarrow.csv.ParseOptions(delimiter="\t", quote_char=False),
+        convert_options=pyarrow.csv.ConvertOptions(
+            column_types={
+                column: dtype for column, (_name, dtype) in SEGMENT_COLUMNS.items()
+            },
+            include_columns=list(SEGMENT_COLUMNS),
+        ),
+    )
+    return table.rename_columns([name for name, _dtype in SEGMENT_COLUMNS.values()])
+
 
 def find_segments(audio_file, result_file, confidence_threshold):
     """Find segments in the result file that meet the confidence threshold."""
@@ -124,6 +275,7 @@ def find_segments(audio_file, result_file, confidence_threshold):
 
     return segments
 
+
 if __name__ == "__main__":
     setup_logging()
 
@@ -133,28 +285,57 @@ if __name__ == "__main__":
         default="config_connection.yaml",
         help="Path to the configuration file.",
     )
+    parser.add_argument(
+        "--report",
+        default=None,
+        help="CSV file listing the audio files without result and the orphan results.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Processes parsing the result files, all CPUs by default.",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Rebuild the detection dataset instead of ingesting the new result files.",
+    )
     args = parser.parse_args()
 
-    with open(args.config) as config_file:
-        config = yaml.load(config_file, Loader=yaml.FullLoader)
+    with pathlib.Path(args.config).open() as config_file:
+        config = yaml.safe_load(config_file)
 
     myfs = do_connection(config["CONNECTION_STRING"])
-    parsed_folders = parse_folders(myfs, config["INPUT_PATH"], config["OUTPUT_PATH_BIRDNET"])
-    parsed_segments = parse_files(
-        parsed_folders, max_segments=config["NUM_SEGMENTS"], threshold=config["THRESHOLD"]
+    match = parse_folders(
+        myfs, config["INPUT_PATH"], config["OUTPUT_PATH_BIRDNET"], open_catalog(config)
     )
+    if args.report:
+        write_match_report(match, args.report)
+    site_pattern = config.get("SITE_PATTERN", cfg.SITE_PATTERN)
+    partition_by = config.get("PARTITION_BY", ["species"])
 
-    # Create a Parquet table
-    table = pa.table(
-        {
-            "audio": [segment["audio"] for segment in parsed_segments],
-            "start": [segment["start"] for segment in parsed_segments],
-            "end": [segment["end"] for segment in parsed_segments],
-            "species": [segment["species"] for segment in parsed_segments],
-            "confidence": [segment["confidence"] for segment in parsed_segments],
-        }
-    )
+    def read_tables(pairs):
+        file_list = [{"audio": audio, "result": result} for audio, result in pairs]
+        for table in iter_segment_tables(
+            file_list, threshold=config["THRESHOLD"], workers=args.workers
+        ):
+            yield add_site_columns(table, site_pattern)
 
-    # Write the table to a Parquet file
-    pq.write_table(table, "sample.parquet")
-    logging.info("Parquet file written successfully with all segments!")
\ No newline at end of file
+    # Stream the detections of the new and changed result files into a
+    # Parquet dataset partitioned by species
+    files, rows = ingest_detections(
+        zip(
+            match.pairs["audio"].to_pylist(),
+            match.pairs["result"].to_pylist(),
+            strict=True,
+        ),
+        config.get("PARQUET_DB", "sample.parquet"),
+        read_tables,
+        ingest_params(config["THRESHOLD"], partition_by, site_pattern),
+        partition_by=partition_by,
+        full=args.full,
+    )
+    logging.info(
+        f"Parquet dataset updated with {rows} segments from {files} result files!"
+    )
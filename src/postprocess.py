@@ -0,0 +1,65 @@
+import numpy as np
+
+
+def species_mask(labels, species_list):
+    """Boolean mask over ``labels`` of the species to report.
+
+    An empty species list keeps every label.
+    """
+    if not species_list:
+        return np.ones(len(labels), dtype=bool)
+    return np.isin(np.asarray(labels), np.asarray(list(species_list)))
+
+
+def filter_scores(scores, min_confidence, mask=None, top_k=0):
+    """Selects the detections to report from a score matrix.
+
+    Works on the whole ``(n_chunks, n_labels)`` matrix at once, only the
+    surviving detections are returned.
+
+    Args:
+        scores: Array of shape (n_chunks, n_labels).
+        min_confidence: Scores must be strictly above this value.
+        mask: Optional boolean array of shape (n_labels,) or
+            (n_chunks, n_labels) of the labels allowed per chunk.
+        top_k: If > 0, keep at most the ``top_k`` best labels per chunk.
+
+    Returns:
+        Arrays ``(chunk_idx, label_idx, confidence)`` sorted by chunk and by
+        decreasing confidence within a chunk.
+    """
+    scores = np.asarray(scores)
+    keep = scores > min_confidence
+    if mask is not None:
+        keep &= mask
+
+    if 0 < top_k < scores.shape[1]:
+        masked = np.where(keep, scores, -np.inf)
+        top = np.argpartition(masked, -top_k, axis=1)[:, -top_k:]
+        in_top = np.zeros_like(keep)
+        np.put_along_axis(in_top, top, True, axis=1)
+        keep &= in_top
+
+    chunk_idx, label_idx = np.nonzero(keep)
+    confidence = scores[chunk_idx, label_idx]
+    order = np.lexsort((-confidence, chunk_idx))
+
+    return chunk_idx[order], label_idx[order], confidence[order]
+
+
+def get_detections(scores, timestamps, min_confidence, mask=None, top_k=0):
+    """Filters a score matrix into (start, end, label index, confidence) tuples.
+
+    See ``filter_scores`` for the arguments, ``timestamps`` holds the
+    [start, end] of every chunk.
+    """
+    chunk_idx, label_idx, confidence = filter_scores(
+        scores, min_confidence, mask=mask, top_k=top_k
+    )
+
+    return [
+        (*timestamps[c], label, conf)
+        for c, label, conf in zip(
+            chunk_idx.tolist(), label_idx.tolist(), confidence.tolist(), strict=True
+        )
+    ]
@@ -0,0 +1,106 @@
+import queue
+import threading
+
+_DONE = object()
+
+
+class Prefetcher:
+    """Fetches and decodes files in background threads ahead of the analysis.
+
+    Iterating yields ``(path, data, error)`` tuples in completion order. At most
+    ``depth`` loaded files wait in the queue. A load only starts while the
+    loaded and loading data, counting the largest file seen so far for every
+    load in flight, fit in ``max_bytes`` (or nothing else is held), so the cap
+    is only exceeded by a file larger than all the previous ones. An error
+    raised by ``paths`` is raised by the iteration once the loaded files
+    are consumed.
+
+    Args:
+        paths: Iterable of file paths.
+        load: Function loading a path into a list of ``(offset, wave)``
+            windows.
+        depth: Number of files loaded ahead of the consumer.
+        workers: Number of loader threads, defaults to ``depth``.
+        max_bytes: Memory cap for loaded but not yet consumed data.
+        sizeof: Function returning the size in bytes of loaded data, defaults
+            to the size of the waves of a list of windows.
+    """
+
+    def __init__(self, paths, load, depth=2, workers=None, max_bytes=None, sizeof=None):
+        self._paths = iter(paths)
+        self._load = load
+        self._sizeof = sizeof or _nbytes
+        self._queue = queue.Queue(maxsize=max(1, depth))
+        self._max_bytes = max_bytes
+        self._queued_bytes = 0
+        self._largest = 0
+        self._error = None
+        self._lock = threading.Lock()
+        self._memory = threading.Condition(self._lock)
+        self._workers = [
+            threading.Thread(target=self._work, daemon=True)
+            for _ in range(workers or max(1, depth))
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def _next_path(self):
+        with self._lock:
+            if self._error is not None:
+                return _DONE
+            return next(self._paths, _DONE)
+
+    def _reserve(self):
+        """Waits for memory and reserves the expected size of the next file."""
+        with self._memory:
+            if self._max_bytes:
+                self._memory.wait_for(
+                    lambda: self._queued_bytes == 0
+                    or self._queued_bytes + self._largest <= self._max_bytes
+                )
+            self._queued_bytes += self._largest
+            return self._largest
+
+    def _work(self):
+        try:
+            while (path := self._next_path()) is not _DONE:
+                reserved = self._reserve()
+                try:
+                    data, error = self._load(path), None
+                except Exception as e:
+                    data, error = None, e
+
+                nbytes = self._sizeof(data) if data is not None else 0
+                with self._memory:
+                    self._queued_bytes += nbytes - reserved
+                    self._largest = max(self._largest, nbytes)
+                    self._memory.notify_all()
+                self._queue.put((path, data, error, nbytes))
+        except BaseException as e:
+            with self._lock:
+                self._error = self._error or e
+        finally:
+            self._queue.put(_DONE)
+
+    def __iter__(self):
+        n_running = len(self._workers)
+        while n_running:
+            item = self._queue.get()
+            if item is _DONE:
+                n_running -= 1
+                continue
+
+            path, data, error, nbytes = item
+            with self._memory:
+                self._queued_bytes -= nbytes
+                self._memory.notify_all()
+            yield path, data, error
+
+        if self._error is not None:
+            raise self._error
+
+
+def _nbytes(data):
+    if data is None:
+        return 0
+    return sum(wave.nbytes for _offset, wave in data)
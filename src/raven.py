@@ -0,0 +1,60 @@
+import pathlib
+
+RAVEN_TABLE_HEADER = (
+    "Selection\tView\tChannel\tBegin Time (s)\tEnd Time (s)\tLow Freq (Hz)"
+    "\tHigh Freq (Hz)\tCommon Name\tSpecies Code\tConfidence\tBegin Path"
+    "\tFile Offset (s)\n"
+)
+
+
+def frequency_range(sample_rate, sig_fmin, sig_fmax, bandpass_fmin, bandpass_fmax):
+    """Low and high frequency written to the selection table."""
+    high_freq = min(sample_rate / 2, sig_fmax, bandpass_fmax)
+    low_freq = max(sig_fmin, bandpass_fmin)
+    return low_freq, high_freq
+
+
+def write_raven_table(
+    detections,
+    registry,
+    afile_path,
+    result_path,
+    low_freq,
+    high_freq,
+    add_nocall=True,
+):
+    """Writes detections to a Raven selection table.
+
+    Args:
+        detections: (start, end, label index, confidence) tuples, already
+            filtered and sorted by time and confidence.
+        registry: The ``labels.LabelRegistry`` of the model.
+        afile_path: Path of the audio file, written to the Begin Path column.
+        result_path: Path of the selection table.
+        low_freq: Value of the Low Freq column.
+        high_freq: Value of the High Freq column.
+        add_nocall: Write a ``nocall`` row when there are no detections.
+    """
+    rows = (
+        f"{selection_id}\tSpectrogram 1\t1\t{start}\t{end}\t{low_freq}\t{high_freq}"
+        f"\t{registry.common_names[label_idx]}\t{registry.codes[label_idx]}"
+        f"\t{confidence:.4f}\t{afile_path}\t{start}\n"
+        for selection_id, (start, end, label_idx, confidence) in enumerate(
+            detections, start=1
+        )
+    )
+
+    pathlib.Path(result_path).parent.mkdir(parents=True, exist_ok=True)
+    with pathlib.Path(result_path).open("w", encoding="utf-8") as rfile:
+        rfile.write(RAVEN_TABLE_HEADER)
+        rfile.writelines(rows)
+
+        # If we don't have any valid predictions, we still need to add a line
+        # to the selection table in case we want to combine results
+        # TODO: That's a weird way to do it, but it works for now. It would be
+        # better to keep track of file durations during the analysis.
+        if not detections and add_nocall:
+            rfile.write(
+                f"1\tSpectrogram 1\t1\t0\t3\t{low_freq}\t{high_freq}"
+                f"\tnocall\tnocall\t1.0\t{afile_path}\t0\n"
+            )
@@ -0,0 +1,194 @@
+import argparse
+import json
+import logging
+import pathlib
+import sys
+
+import config as cfg
+import pyarrow as pa
+import pyarrow.parquet as pq
+from labels import LabelRegistry
+from postprocess import get_detections
+from raven import frequency_range, write_raven_table
+from scores import SCORES_SUFFIX, load_scores
+from species_filter import species_mask_for
+
+DETECTION_SCHEMA = pa.schema(
+    [
+        ("audio", pa.string()),
+        ("start", pa.float64()),
+        ("end", pa.float64()),
+        ("species", pa.string()),
+        ("confidence", pa.float64()),
+    ]
+)
+
+
+def read_lines(path):
+    """Non-empty lines of a text file, an empty list if no path is given."""
+    if not path:
+        return []
+    with pathlib.Path(path).open(encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def find_score_files(paths):
+    """Yields (score file, path relative to its input folder) pairs."""
+    for path in map(pathlib.Path, paths):
+        if path.is_dir():
+            for score_file in sorted(path.rglob("*" + SCORES_SUFFIX)):
+                yield str(score_file), str(score_file.relative_to(path))
+        else:
+            yield str(path), path.name
+
+
+def load_registry(labels_file, codes_file, species_list_file):
+    """Builds the label registry without loading the model."""
+    codes = {}
+    if codes_file and pathlib.Path(codes_file).is_file():
+        with pathlib.Path(codes_file).open() as cf:
+            codes = json.load(cf)
+
+    return LabelRegistry(
+        read_lines(labels_file), codes=codes, species_list=read_lines(species_list_file)
+    )
+
+
+def reexport(args, registry):
+    """Regenerates selection tables or detection rows from saved score matrices.
+
+    Scores below the floor of a matrix were saved as 0, so a
+    ``min_confidence`` below it gives incomplete results and is warned about.
+    The bandpass options only set the Low/High Freq columns of the tables,
+    the scores were computed on the audio filtered at analysis time. Species
+    are masked like in the analysis, with the species list and, when
+    ``cfg.LOCATION_FILTER`` is set, the site and week of each recording.
+    """
+    # species_mask_for() reads the labels from the config like the analysis
+    cfg.LABEL_REGISTRY = registry
+    writer = None
+    n_files, n_detections = 0, 0
+    warned_floor = False
+
+    for score_file, rel_path in find_score_files(args.scores):
+        data = load_scores(score_file)
+        if data["scores"].shape[1] != len(registry):
+            logging.error(
+                f"{score_file} has {data['scores'].shape[1]} labels,"
+                f" expected {len(registry)}"
+            )
+            continue
+        floor = data["floor"] if data["floor"] is not None else cfg.SCORES_FLOOR
+        if args.min_confidence < floor and not warned_floor:
+            logging.warning(
+                f"{score_file} stores scores from {floor} only, detections below it"
+                f" are missing with --min_confidence {args.min_confidence}"
+            )
+            warned_floor = True
+        if data["model_version"] != cfg.MODEL_VERSION:
+            logging.warning(
+                f"{score_file} was produced by model {data['model_version']}"
+            )
+
+        detections = get_detections(
+            data["scores"],
+            data["timestamps"].tolist(),
+            args.min_confidence,
+            mask=species_mask_for(data["audio_path"]),
+            top_k=args.top_k,
+        )
+
+        if args.format == "table":
+            low_freq, high_freq = frequency_range(
+                data["sample_rate"],
+                cfg.SIG_FMIN,
+                cfg.SIG_FMAX,
+                args.bandpass_fmin,
+                args.bandpass_fmax,
+            )
+            result_path = pathlib.Path(args.output) / (
+                rel_path.removesuffix(SCORES_SUFFIX) + ".selection.table.txt"
+            )
+            write_raven_table(
+                detections,
+                registry,
+                data["audio_path"],
+                result_path,
+                low_freq,
+                high_freq,
+            )
+        else:
+            if writer is None:
+                writer = pq.ParquetWriter(args.output, DETECTION_SCHEMA)
+            start, end, label_idx, confidence = (
+                zip(*detections, strict=True) if detections else ([], [], [], [])
+            )
+            writer.write_table(
+                pa.table(
+                    {
+                        "audio": [data["audio_path"]] * len(detections),
+                        "start": start,
+                        "end": end,
+                        "species": [registry.common_names[i] for i in label_idx],
+                        "confidence": confidence,
+                    },
+                    schema=DETECTION_SCHEMA,
+                )
+            )
+
+        n_files += 1
+        n_detections += len(detections)
+
+    if writer is not None:
+        writer.close()
+
+    logging.info(f"Re-exported {n_detections} detections from {n_files} files")
+    return n_files, n_detections
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+
+    script_dir = pathlib.Path(sys.argv[0]).parent.absolute() / "birdnetsrc"
+
+    parser = argparse.ArgumentParser(
+        description="Re-export BirdNET results from saved score matrices."
+    )
+    parser.add_argument(
+        "scores", nargs="+", help="Score files (.scores.npz) or folders with them."
+    )
+    parser.add_argument(
+        "--output",
+        required=True,
+        help="Output folder for selection tables, or parquet file for detections.",
+    )
+    parser.add_argument("--format", choices=["table", "parquet"], default="table")
+    parser.add_argument("--min_confidence", type=float, default=cfg.MIN_CONFIDENCE)
+    parser.add_argument("--top_k", type=int, default=cfg.TOP_K)
+    parser.add_argument("--species_list", default=None)
+    parser.add_argument(
+        "--location_filter",
+        action=argparse.BooleanOptionalAction,
+        default=cfg.LOCATION_FILTER,
+        help="Only keep the species expected at the site and week of each "
+        "recording, see LOCATION_FILTER in config.py.",
+    )
+    parser.add_argument(
+        "--bandpass_fmin",
+        type=int,
+        default=cfg.BANDPASS_FMIN,
+        help="Low Freq of the tables, the audio is not filtered again.",
+    )
+    parser.add_argument(
+        "--bandpass_fmax",
+        type=int,
+        default=cfg.BANDPASS_FMAX,
+        help="High Freq of the tables, the audio is not filtered again.",
+    )
+    parser.add_argument("--labels_file", default=script_dir / cfg.LABELS_FILE)
+    parser.add_argument("--codes_file", default=script_dir / cfg.CODES_FILE)
+    args = parser.parse_args()
+    cfg.LOCATION_FILTER = args.location_filter
+
+    registry = load_registry(args.labels_file, args.codes_file, args.species_list)
+    reexport(args, registry)
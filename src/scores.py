@@ -0,0 +1,101 @@
+import pathlib
+
+import numpy as np
+
+SCORES_SUFFIX = ".scores.npz"
+
+
+def scores_path_for(result_path):
+    """Path of the score matrix stored next to a selection table."""
+    base = result_path.removesuffix(".txt").removesuffix(".selection.table")
+    return base + SCORES_SUFFIX
+
+
+def save_scores(
+    path,
+    scores,
+    timestamps,
+    audio_path,
+    model_version,
+    sample_rate,
+    dtype="float16",
+    floor=0.0,
+    skipped=None,
+):
+    """Saves the full chunk x label score matrix of a file as a compressed NPZ.
+
+    Args:
+        path: Output ``.npz`` path.
+        scores: Array of shape (n_chunks, n_labels).
+        timestamps: The [start, end] of every chunk.
+        audio_path: Path of the analysed audio file.
+        model_version: Version of the model that produced the scores.
+        sample_rate: Sample rate used for the analysis.
+        dtype: ``float16`` or ``uint8`` (linear quantization between the
+            matrix minimum and maximum).
+        floor: Scores below this value are stored as 0, which makes the
+            matrix compress much better. It is saved with the matrix, as
+            detections below it cannot be re-exported.
+        skipped: Optional boolean mask of the chunks the model was not run
+            on (silence gate).
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    if floor > 0:
+        scores = np.where(scores < floor, 0, scores)
+
+    lo, hi = (float(scores.min()), float(scores.max())) if scores.size else (0.0, 1.0)
+    if dtype == "uint8":
+        scale = (hi - lo) or 1.0
+        data = np.round((scores - lo) / scale * 255).astype(np.uint8)
+    elif dtype == "float16":
+        data = scores.astype(np.float16)
+    else:
+        raise ValueError(f"Unsupported score dtype {dtype}")
+
+    pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+    np.savez_compressed(
+        path,
+        scores=data,
+        timestamps=np.asarray(timestamps, dtype=np.float64).reshape(-1, 2),
+        audio_path=np.array(str(audio_path)),
+        model_version=np.array(model_version),
+        sample_rate=np.array(sample_rate),
+        score_range=np.array([lo, hi], dtype=np.float32),
+        floor=np.array(float(floor)),
+        skipped=(
+            np.zeros(len(scores), dtype=bool)
+            if skipped is None
+            else np.asarray(skipped, dtype=bool)
+        ),
+    )
+
+
+def load_scores(path):
+    """Loads a score matrix saved by ``save_scores``.
+
+    Returns:
+        A dict with ``scores`` (float32), ``timestamps``, ``audio_path``,
+        ``model_version``, ``sample_rate``, ``skipped`` and ``floor`` (None
+        for files saved before the floor was recorded).
+    """
+    with np.load(path) as npz:
+        data = npz["scores"]
+        if data.dtype == np.uint8:
+            lo, hi = npz["score_range"]
+            scores = data.astype(np.float32) / 255 * ((hi - lo) or 1.0) + lo
+        else:
+            scores = data.astype(np.float32)
+
+        return {
+            "scores": scores,
+            "timestamps": npz["timestamps"],
+            "audio_path": str(npz["audio_path"]),
+            "model_version": str(npz["model_version"]),
+            "sample_rate": int(npz["sample_rate"]),
+            "skipped": (
+                npz["skipped"]
+                if "skipped" in npz
+                else np.zeros(len(scores), dtype=bool)
+            ),
+            "floor": float(npz["floor"]) if "floor" in npz else None,
+        }
@@ -0,0 +1,59 @@
+import numpy as np
+
+
+def chunk_levels(chunks, sr, mode="rms", fmin=0, fmax=None, block_size=32):
+    """Level of every chunk in dB relative to full scale.
+
+    Args:
+        chunks: Sequence of equally long chunks.
+        sr: Sample rate of the chunks.
+        mode: ``rms`` for the broadband level, ``band`` for the level within
+            ``fmin``-``fmax`` only.
+        fmin: Lower frequency of the band (Hz).
+        fmax: Upper frequency of the band (Hz), defaults to sr / 2.
+        block_size: Number of chunks transformed at once in ``band`` mode.
+
+    Returns:
+        Array of shape (n_chunks,).
+    """
+    x = np.asarray(chunks, dtype=np.float32)
+    if x.size == 0:
+        return np.empty(0, dtype=np.float32)
+
+    if mode == "rms":
+        power = np.mean(np.square(x), axis=1)
+    elif mode == "band":
+        n = x.shape[1]
+        freqs = np.fft.rfftfreq(n, 1 / sr)
+        band = (freqs >= fmin) & (freqs <= (fmax or sr / 2))
+        power = np.concatenate(
+            [
+                # One-sided Parseval: mean(x**2) ~ 2 * sum(|X|**2) / n**2
+                2
+                * np.sum(np.abs(np.fft.rfft(block, axis=1)[:, band]) ** 2, axis=1)
+                / n**2
+                for block in np.array_split(x, max(1, len(x) // block_size))
+            ]
+        )
+    else:
+        raise ValueError(f"Unknown level mode {mode}")
+
+    return 10 * np.log10(np.maximum(power, 1e-20))
+
+
+def silent_chunks(chunks, sr, mode, threshold_db, fmin=0, fmax=None):
+    """Boolean mask of the chunks whose level is below ``threshold_db``."""
+    return chunk_levels(chunks, sr, mode, fmin, fmax) < threshold_db
+
+
+def silent_ranges(timestamps, skipped):
+    """``[start, end]`` ranges (s) covered by consecutive skipped chunks."""
+    ranges = []
+    for (start, end), silent in zip(timestamps, skipped, strict=True):
+        if not silent:
+            continue
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], float(end))
+        else:
+            ranges.append([float(start), float(end)])
+    return ranges
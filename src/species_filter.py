@@ -0,0 +1,93 @@
+import csv
+import datetime
+import functools
+import logging
+import pathlib
+import posixpath
+import re
+
+import config as cfg
+from birdnetsrc.species import getSpeciesList
+
+
+def week_of_year(date):
+    """BirdNET week (1-48, four weeks per month) of a date."""
+    return (date.month - 1) * 4 + min(4, (date.day - 1) // 7 + 1)
+
+
+@functools.cache
+def load_site_table(path):
+    """Reads a ``site,latitude,longitude`` CSV into {site: (lat, lon)}."""
+    with pathlib.Path(path).open(newline="") as f:
+        return {
+            row["site"]: (float(row["latitude"]), float(row["longitude"]))
+            for row in csv.DictReader(f)
+        }
+
+
+def recording_location(fpath):
+    """Site coordinates and week of a recording, from its path and the site table.
+
+    The path is matched against ``cfg.SITE_PATTERN``, whose named groups can
+    give the ``site`` (looked up in ``cfg.SITE_TABLE``), ``lat``/``lon`` and
+    the ``date`` (YYYYMMDD). Missing values fall back to ``cfg.LATITUDE``,
+    ``cfg.LONGITUDE`` and ``cfg.WEEK``.
+
+    Returns:
+        (latitude, longitude, week), the coordinates are None when unknown.
+    """
+    lat, lon, week = cfg.LATITUDE, cfg.LONGITUDE, cfg.WEEK
+    match = re.search(cfg.SITE_PATTERN, str(fpath)) if cfg.SITE_PATTERN else None
+    groups = match.groupdict() if match else {}
+
+    if groups.get("site") and cfg.SITE_TABLE:
+        lat, lon = load_site_table(cfg.SITE_TABLE).get(groups["site"], (lat, lon))
+    if groups.get("lat") and groups.get("lon"):
+        lat, lon = float(groups["lat"]), float(groups["lon"])
+    if groups.get("date"):
+        try:
+            week = week_of_year(datetime.datetime.strptime(groups["date"], "%Y%m%d"))
+        except ValueError:
+            pass
+
+    if lat == -1 and lon == -1:
+        return None, None, week
+    return lat, lon, week
+
+
+@functools.lru_cache(maxsize=4096)
+def location_mask(lat, lon, week, threshold):
+    """Label mask of the species expected at a location and week.
+
+    Runs the metadata model once per (location, week), later calls for the
+    same site and week are served from the cache.
+    """
+    return cfg.LABEL_REGISTRY.mask_for(getSpeciesList(lat, lon, week, threshold))
+
+
+def species_mask_for(fpath):
+    """Species mask of a recording: species list and location/week filter."""
+    mask = cfg.LABEL_REGISTRY.species_mask
+    if not cfg.LOCATION_FILTER:
+        return mask
+
+    lat, lon, week = recording_location(fpath)
+    if lat is None:
+        _warn_no_location(_site_of(fpath))
+        return mask
+
+    return mask & location_mask(lat, lon, week, cfg.LOCATION_FILTER_THRESHOLD)
+
+
+def _site_of(fpath):
+    """Site of a recording from ``cfg.SITE_PATTERN``, else its folder."""
+    match = re.search(cfg.SITE_PATTERN, str(fpath)) if cfg.SITE_PATTERN else None
+    if match and match.groupdict().get("site"):
+        return match["site"]
+    return posixpath.dirname(str(fpath))
+
+
+@functools.cache
+def _warn_no_location(site):
+    # Logged once per site, not for every recording
+    logging.warning(f"No location for {site}, the location filter is not applied")
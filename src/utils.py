@@ -1,29 +1,170 @@
+import contextlib
 import glob
 import os
+import pathlib
 import shutil
+import signal
+import subprocess
 import tempfile
+import threading
 
-import audioread
-import fsspec
 import librosa
+import numpy as np
+import soundfile as sf
+from audio_cache import get_audio_cache, is_remote, open_audio
+from matching import is_result_table, match_files, strip_extension
+from metrics import FileMetrics, MeteredFile
 
+FFMPEG = shutil.which("ffmpeg")
 
-def read_file(filepath, sr):
-    # Step 1: Create a temporary directory for this process
-    # temp_dir = tempfile.mkdtemp(prefix="tmp_", dir="/tmp")
-    # print(f"Created temp directory: {temp_dir}")
 
-    # Step 2: Use fsspec and configure it to use the temp_dir for caching
-    with fsspec.open(
-        filepath
-    ) as f:  #     with fsspec.open(filepath, block_cache_dir=temp_dir) as f:
-        wave, fs = librosa.load(f, sr=sr, mono=True, res_type="kaiser_fast")
+def read_file(filepath, sr, metrics=None):
+    metrics = metrics or FileMetrics(filepath)
+
+    # Remote files are read through the local audio cache when configured
+    with metrics.stage("fetch"):
+        f = open_audio(filepath)
+    with f, metrics.stage("decode", exclude=("fetch", "resample")):
+        wave, fs = decode_audio(MeteredFile(f, metrics), sr, metrics=metrics)
 
-    # Return the data and the temp directory path (for later cleanup)
     return (
         wave,
         fs,
-    )  # temp_dir
+    )
+
+
+def decode_audio(source, sr, offset=0.0, duration=None, metrics=None):
+    """Decodes audio to mono float32 at ``sr`` by the cheapest correct path.
+
+    The header is probed first. Files libsndfile can read (WAV, FLAC, ...)
+    that are already at ``sr`` are read directly as PCM, without resampling.
+    Everything else is decoded and resampled by ffmpeg when it is installed,
+    and by soundfile/librosa otherwise.
+
+    Args:
+        source: Local path or open binary file object.
+        sr: Target sample rate.
+        offset: Start reading after this time (in seconds).
+        duration: Only load up to this much audio (in seconds).
+        metrics: Optional ``metrics.FileMetrics`` receiving the resampling time.
+
+    Returns:
+        The signal and its sample rate.
+    """
+    metrics = metrics or FileMetrics(source)
+
+    try:
+        snd = sf.SoundFile(source)
+    except RuntimeError:
+        snd = None
+
+    if snd is not None and (snd.samplerate == sr or not FFMPEG):
+        with snd:
+            snd.seek(int(offset * snd.samplerate))
+            frames = int(duration * snd.samplerate) if duration is not None else -1
+            wave = snd.read(frames, dtype="float32", always_2d=True).mean(axis=1)
+            if snd.samplerate != sr:
+                with metrics.stage("resample"):
+                    wave = librosa.resample(
+                        wave,
+                        orig_sr=snd.samplerate,
+                        target_sr=sr,
+                        res_type="kaiser_fast",
+                    )
+        return wave, sr
+
+    if snd is not None:
+        snd.close()
+    if hasattr(source, "seek"):
+        source.seek(0)
+
+    if FFMPEG:
+        return _ffmpeg_decode(source, sr, offset, duration, metrics), sr
+
+    return librosa.load(
+        source,
+        sr=sr,
+        mono=True,
+        offset=offset,
+        duration=duration,
+        res_type="kaiser_fast",
+    )
+
+
+def _ffmpeg_decode(source, sr, offset, duration, metrics):
+    with _ffmpeg_process(source, sr, offset, duration, metrics) as proc:
+        data = proc.stdout.read()
+    return np.frombuffer(data, dtype=np.float32)
+
+
+@contextlib.contextmanager
+def _ffmpeg_process(source, sr, offset=0.0, duration=None, metrics=None):
+    """Runs ffmpeg decoding ``source`` to mono float32 at ``sr`` on its stdout.
+
+    Local files, including open files of the audio cache, are read by ffmpeg
+    itself. Other file objects are copied to its stdin by a thread, so they
+    are never held in memory as a whole.
+
+    Raises:
+        subprocess.CalledProcessError: If ffmpeg fails, once its output was
+            read.
+    """
+    path = _local_path(source)
+    if path is not None and not isinstance(source, str | os.PathLike) and metrics:
+        metrics.count("bytes_read", pathlib.Path(path).stat().st_size)
+
+    cmd = [FFMPEG, "-nostdin", "-v", "error", "-ss", str(offset)]
+    if duration is not None:
+        cmd += ["-t", str(duration)]
+    cmd += ["-i", path if path is not None else "pipe:0"]
+    cmd += ["-f", "f32le", "-ac", "1", "-ar", str(sr), "pipe:1"]
+
+    with subprocess.Popen(
+        cmd,  # noqa: S603
+        stdin=subprocess.DEVNULL if path is not None else subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    ) as proc:
+        feeder = None
+        if path is None:
+            feeder = threading.Thread(
+                target=_feed, args=(source, proc.stdin), daemon=True
+            )
+            feeder.start()
+        try:
+            yield proc
+        finally:
+            if proc.stdout.read(1):
+                # Stopped before the end of the output
+                proc.kill()
+            proc.wait()
+            if feeder is not None:
+                feeder.join()
+        if proc.returncode and proc.returncode != -signal.SIGKILL:
+            raise subprocess.CalledProcessError(
+                proc.returncode, cmd, stderr=proc.stderr.read()
+            )
+
+
+def _feed(source, stdin):
+    """Copies a file object to the stdin of a process until it stops reading."""
+    try:
+        shutil.copyfileobj(source, stdin, 1024 * 1024)
+    except (BrokenPipeError, ValueError):
+        pass
+    finally:
+        with contextlib.suppress(BrokenPipeError):
+            stdin.close()
+
+
+def _local_path(source):
+    """Path of a source that is, or is an open file of, a local file."""
+    if isinstance(source, str | os.PathLike):
+        return os.fspath(source)
+    name = getattr(source, "name", None)
+    if isinstance(name, str) and pathlib.Path(name).is_file():
+        return name
+    return None
 
 
 def clean_tmp(temp_dir):
@@ -35,21 +176,114 @@ def clean_tmp(temp_dir):
         print(f"Failed to delete temp directory {temp_dir}. Reason: {e}")
 
 
-def read_audio_data(path, sr):
-    try:
-        ndarray, rate = read_file(path, sr)  # , tmpdir
-        duration = librosa.get_duration(y=ndarray, sr=sr)
-    except audioread.exceptions.NoBackendError as e:
-        print(e)
+def read_audio_data(path, sr, metrics=None):
+    # Decoding errors, e.g. audioread's NoBackendError, are left to the caller
+    ndarray, rate = read_file(path, sr, metrics)  # , tmpdir
+    duration = librosa.get_duration(y=ndarray, sr=sr)
     return ndarray, rate, duration  # , tmpdir
 
 
-def openCachedFile(filesystem, path, sample_rate=48000, offset=0.0, duration=None):
-    import shutil
+def stream_audio_data(path, sr, window, overlap=0.0, metrics=None):
+    """Yields a recording as consecutive ``(offset, wave)`` windows.
+
+    Each window holds ``window + overlap`` seconds of mono audio resampled to
+    ``sr`` and starts ``window`` seconds after the previous one, so memory
+    usage depends on the window size and not on the file length.
+    """
+    metrics = metrics or FileMetrics(path)
+
+    with metrics.stage("fetch"):
+        f = open_audio(path)
+    with f:
+        try:
+            snd = sf.SoundFile(MeteredFile(f, metrics))
+        except RuntimeError:
+            snd = None
+
+        if snd is not None:
+            with snd:
+                yield from _stream_soundfile(snd, sr, window, overlap, metrics)
+            return
+
+    # Other formats are decoded in a single pass, by an ffmpeg pipe read
+    # window by window when ffmpeg is installed
+    if FFMPEG:
+        with metrics.stage("fetch"):
+            f = open_audio(path)
+        with f:
+            yield from _stream_ffmpeg(
+                MeteredFile(f, metrics), sr, window, overlap, metrics
+            )
+        return
+
+    wave, _ = read_file(path, sr, metrics)
+    yield from _split_windows(wave, sr, window, overlap)
+
+
+def _stream_ffmpeg(source, sr, window, overlap, metrics):
+    step = int(window * sr)
+    length = int((window + overlap) * sr)
+    itemsize = np.dtype(np.float32).itemsize
+
+    with _ffmpeg_process(source, sr, metrics=metrics) as proc:
+        wave = np.empty(0, dtype=np.float32)
+        start = 0
+        while True:
+            with metrics.stage("decode", exclude=("fetch",)):
+                data = proc.stdout.read((length - len(wave)) * itemsize)
+            wave = np.concatenate([wave, np.frombuffer(data, dtype=np.float32)])
+            if not len(wave):
+                break
+            yield start / sr, wave
+            if len(wave) < length:
+                break
+            # The overlap is kept for the next window
+            wave = wave[step:]
+            start += step
 
-    bin = filesystem.openbin(path)
 
-    with tempfile.NamedTemporaryFile() as temp:
+def _split_windows(wave, sr, window, overlap):
+    step = int(window * sr)
+    length = int((window + overlap) * sr)
+    for start in range(0, len(wave), step):
+        yield start / sr, wave[start : start + length]
+
+
+def _stream_soundfile(snd, sr, window, overlap, metrics):
+    step = int(window * snd.samplerate)
+    length = int((window + overlap) * snd.samplerate)
+
+    for start in range(0, snd.frames, step):
+        with metrics.stage("decode", exclude=("fetch",)):
+            snd.seek(start)
+            wave = snd.read(length, dtype="float32", always_2d=True).mean(axis=1)
+        if snd.samplerate != sr:
+            with metrics.stage("resample"):
+                wave = librosa.resample(
+                    wave, orig_sr=snd.samplerate, target_sr=sr, res_type="kaiser_fast"
+                )
+        yield start / snd.samplerate, wave
+
+
+def openCachedFile(
+    filesystem, path, sample_rate=48000, offset=0.0, duration=None, url=None
+):
+    """Reads a file of a pyfilesystem2 filesystem (e.g. SSH).
+
+    With an audio cache configured, the file is downloaded into the cache
+    under ``url``, the location of the file as seen by the analysis, and
+    later calls read the cached copy.
+    """
+    if url is not None and is_remote(url) and get_audio_cache() is not None:
+
+        def download(dst):
+            with filesystem.openbin(path) as src:
+                shutil.copyfileobj(src, dst)
+
+        with open_audio(url, download) as f:
+            return openAudioFile(f, sample_rate, offset, duration)
+
+    with filesystem.openbin(path) as bin, tempfile.NamedTemporaryFile() as temp:
         shutil.copyfileobj(bin, temp)
         sig, rate = openAudioFile(temp.name, sample_rate, offset, duration)
 
@@ -58,14 +292,7 @@ def openCachedFile(filesystem, path, sample_rate=48000, offset=0.0, duration=Non
 
 def openAudioFile(path, sample_rate=44100, offset=0.0, duration=None):
     try:
-        sig, rate = librosa.load(
-            path,
-            sr=sample_rate,
-            offset=offset,
-            duration=duration,
-            mono=True,
-            res_type="kaiser_fast",
-        )
+        sig, rate = decode_audio(path, sample_rate, offset, duration)
     except:
         sig, rate = [], sample_rate
 
@@ -73,8 +300,6 @@ def openAudioFile(path, sample_rate=44100, offset=0.0, duration=None):
 
 
 def saveSignal(sig, fname):
-    import soundfile as sf
-
     sf.write(fname, sig, 48000, "PCM_16")
 
 
@@ -84,38 +309,22 @@ def saveSignal(sig, fname):
 
 
 def remove_extension(input):
-    filename = input.split("/")[-1].split(".")[0]
-    if len(filename) > 2:
-        filename = ".".join(filename[0:-1])
-    else:
-        filename = input.split("/")[-1].split(".")[0]
-    return filename
+    """Path without its extension, see ``matching.strip_extension``."""
+    return strip_extension(input)
 
 
 def parseFolders(apath, rpath):
     audio_files = [
         f for f in glob.glob(apath + "/**/*", recursive=True) if os.path.isfile(f)
     ]
-    audio_no_extension = []
-    for audio_file in audio_files:
-        audio_file_no_extension = remove_extension(audio_file)
-        audio_no_extension.append(audio_file_no_extension)
-
     result_files = [
-        f for f in glob.glob(rpath + "/**/*", recursive=True) if os.path.isfile(f)
+        f
+        for f in glob.glob(rpath + "/**/*", recursive=True)
+        if pathlib.Path(f).is_file() and is_result_table(f)
     ]
 
-    flist = []
-    for result in result_files:
-        result_no_extension = remove_extension(result)
-        is_in = result_no_extension in audio_no_extension
-
-        if is_in:
-            audio_idx = audio_no_extension.index(result_no_extension)
-            pair = {"audio": audio_files[audio_idx], "result": result}
-            flist.append(pair)
-        else:
-            continue
+    match = match_files(audio_files, result_files, apath, rpath)
+    flist = match.pairs.select(["audio", "result"]).to_pylist()
 
     print(f"Found {len(flist)} audio files with valid result file.")
 
@@ -0,0 +1,99 @@
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+WavLayout = namedtuple(
+    "WavLayout",
+    ["sample_rate", "channels", "sample_width", "format", "data_offset", "frames"],
+)
+
+
+def read_wav_header(f):
+    """Parses the header of a RIFF/WAVE file without reading its samples.
+
+    Only the chunks before the ``data`` chunk are read, so on a remote file
+    this costs a few small reads whatever the length of the recording.
+
+    Args:
+        f: Seekable binary file object positioned at the start of the file.
+
+    Returns:
+        A ``WavLayout``, or None if the file is not an uncompressed WAV.
+    """
+    riff = f.read(12)
+    if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+        return None
+
+    fmt = None
+    offset = 12
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            return None
+        chunk_id, size = head[:4], struct.unpack("<I", head[4:])[0]
+        offset += 8
+
+        if chunk_id == b"fmt ":
+            body = f.read(size)
+            code, channels, sample_rate = struct.unpack("<HHI", body[:8])
+            bits = struct.unpack("<H", body[14:16])[0]
+            if code == WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                code = struct.unpack("<H", body[24:26])[0]
+            fmt = (code, channels, sample_rate, bits)
+        elif chunk_id == b"data":
+            if fmt is None:
+                return None
+            code, channels, sample_rate, bits = fmt
+            width = bits // 8
+            if code not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT) or not width:
+                return None
+            if size in (0, 0xFFFFFFFF):
+                # Not set by recorders that stream to disk, the data runs
+                # to the end of the file
+                f.seek(0, 2)
+                size = f.tell() - offset
+            return WavLayout(
+                sample_rate, channels, width, code, offset, size // (width * channels)
+            )
+        # Chunks are padded to an even size
+        offset += size + (size % 2)
+        f.seek(offset)
+
+
+def read_wav_frames(f, layout, start, count):
+    """Reads ``count`` frames from frame ``start`` as mono float32.
+
+    Only the bytes of the requested frames are read. Samples are scaled like
+    soundfile does, so the result matches reading the whole file.
+    """
+    start = max(0, min(start, layout.frames))
+    count = max(0, min(count, layout.frames - start))
+    frame_size = layout.sample_width * layout.channels
+    f.seek(layout.data_offset + start * frame_size)
+    data = f.read(count * frame_size)
+    data = data[: len(data) // frame_size * frame_size]
+    return _to_float(data, layout).reshape(-1, layout.channels).mean(axis=1)
+
+
+def _to_float(data, layout):
+    width = layout.sample_width
+    if layout.format == WAVE_FORMAT_IEEE_FLOAT:
+        return np.frombuffer(data, dtype=f"<f{width}").astype(np.float32)
+    if width == 1:
+        return (np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 128) / 128
+    if width == 3:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        # Sign-extend the 24-bit samples into int32
+        samples = (
+            raw[:, 0].astype(np.int32)
+            | (raw[:, 1].astype(np.int32) << 8)
+            | (raw[:, 2].astype(np.int8).astype(np.int32) << 16)
+        )
+        return samples.astype(np.float32) / 2**23
+    samples = np.frombuffer(data, dtype=f"<i{width}")
+    return (samples / float(2 ** (8 * width - 1))).astype(np.float32)